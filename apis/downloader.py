@@ -0,0 +1,164 @@
+r"""
+Async attachment downloader with a local cache directory.
+
+- at most `concurrency` downloads at a time, one pooled `aiohttp` session
+- partial files (`*.part`) are resumed with HTTP Range (+ If-Range on the ETag)
+- cached files are served without touching the network (or revalidated with
+  If-None-Match), identical contents are stored once (sha256 dedup)
+- the cache directory is kept under `max_bytes` by evicting least recently used files
+
+pip install aiohttp
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+
+
+CHUNK_SIZE = 1 << 20
+
+
+def file_name_for(url):
+    r"""
+    cache file name, keyed on sha256(url): urls that share a basename (or differ
+    only in the query) never share a `.part` file or a cache entry. the readable
+    basename and its extension are kept as a suffix
+    """
+    file_name = urlparse(url).path.rstrip("/").split("/")[-1] or "index"
+    if "arxiv" in url and not file_name.endswith(".pdf"):
+        file_name = file_name + ".pdf"
+    return f"{hashlib.sha256(url.encode('utf-8')).hexdigest()[:24]}-{file_name}"
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h
+
+
+class Downloader:
+    def __init__(self, cache_dir="tmp_files", concurrency=8, max_bytes=None, revalidate=False):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.lock = asyncio.Lock()
+        self.url_locks = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+
+    def save_index(self):
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def cached(self, url):
+        entry = self.index.get(url)
+        if entry is not None and os.path.exists(entry["path"]):
+            return entry
+        return None
+
+    async def fetch(self, session, url):
+        # one download per url at a time, a second caller waits and gets the cached file
+        async with self.url_locks.setdefault(url, asyncio.Lock()):
+            return await self._fetch(session, url)
+
+    async def _fetch(self, session, url):
+        entry = self.cached(url)
+        if entry is not None and not self.revalidate:
+            entry["accessed"] = time.time()
+            return entry["path"]
+
+        async with self.semaphore:
+            path = os.path.join(self.cache_dir, file_name_for(url))
+            part = path + ".part"
+            headers = {}
+            if entry is not None and entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset and entry is None:
+                headers["Range"] = f"bytes={offset}-"
+                etag = self.index.get(f"{url}#part", {}).get("etag")
+                if etag:
+                    headers["If-Range"] = etag
+
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    entry["accessed"] = time.time()
+                    return entry["path"]
+                etag = response.headers.get("ETag") or self.index.get(f"{url}#part", {}).get("etag")
+                # 416: the partial file is already complete
+                if response.status != 416:
+                    response.raise_for_status()
+                    if etag:
+                        self.index[f"{url}#part"] = {"etag": etag}
+                    # 206 continues the partial file, 200 means the server restarted it
+                    mode = "ab" if response.status == 206 else "wb"
+                    with open(part, mode) as f:
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            f.write(chunk)
+
+        digest = (await asyncio.to_thread(sha256_file, part)).hexdigest()
+        async with self.lock:
+            self.index.pop(f"{url}#part", None)
+            # same content under another url: keep one copy
+            duplicate = next((e for e in self.index.values()
+                              if e.get("sha256") == digest and os.path.exists(e["path"])), None)
+            if duplicate is not None:
+                os.remove(part)
+                path = duplicate["path"]
+            else:
+                os.replace(part, path)
+            self.index[url] = {
+                "path": path, "etag": etag, "sha256": digest,
+                "size": os.path.getsize(path), "accessed": time.time(),
+            }
+        return path
+
+    def evict(self, keep=()):
+        if self.max_bytes is None:
+            return
+        files = {}
+        for entry in self.index.values():
+            if "path" in entry and os.path.exists(entry["path"]):
+                files[entry["path"]] = max(files.get(entry["path"], 0), entry["accessed"])
+        total = sum(os.path.getsize(path) for path in files)
+        for path in sorted(files, key=files.get):
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            total -= os.path.getsize(path)
+            os.remove(path)
+        self.index = {url: entry for url, entry in self.index.items()
+                      if "path" not in entry or os.path.exists(entry["path"])}
+
+    async def fetch_all(self, urls):
+        r"""
+        download `urls` concurrently, returns the local paths in the same order
+        """
+        unique = list(dict.fromkeys(urls))
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=64)) as session:
+            try:
+                paths = dict(zip(unique, await asyncio.gather(*[self.fetch(session, url) for url in unique])))
+            finally:
+                self.save_index()
+        paths = [paths[url] for url in urls]
+        self.evict(keep=set(paths))
+        self.save_index()
+        return paths
+
+
+async def fetch_all(urls, cache_dir="tmp_files", concurrency=8, max_bytes=None):
+    return await Downloader(cache_dir, concurrency=concurrency, max_bytes=max_bytes).fetch_all(urls)
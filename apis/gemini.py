@@ -1,6 +1,8 @@
 import asyncio
 from gemini_webapi import GeminiClient
 
+from llm_cache import ResponseCache
+
 def load_cookies_from_file(file_path):
     cookies = {}
     try:
@@ -32,6 +34,17 @@ async def main():
         print("Error: __Secure-1PSID cookie not found in cookies.txt")
         return
     
+    # a conversation is cached as a whole, later turns depend on earlier ones
+    messages = ["hi", "论文的详细网络结构"]
+    cache = ResponseCache()
+    key = cache.key("gemini", "default", messages)
+    responses = cache.get(key)
+    if responses is not None:
+        for text in responses:
+            print(text)
+        print(cache.report())
+        return
+
     # Initialize GeminiClient with the extracted cookies
     client = GeminiClient(Secure_1PSID, Secure_1PSIDTS, proxies=None)
     await client.init(timeout=30, auto_close=False, close_delay=300, auto_refresh=True)
@@ -39,10 +52,13 @@ async def main():
     # Here you can add your code to use the client
     # For example:
     chat = client.start_chat()
-    response = await chat.send_message("hi")
-    response1 = await chat.send_message("论文的详细网络结构")
-    print(response.text)
-    print(response1.text)
+    responses = []
+    for message in messages:
+        response = await chat.send_message(message)
+        responses.append(response.text)
+        print(response.text)
+    cache.put(key, responses)
+    print(cache.report())
     
     # Don't forget to close the client when you're done
     await client.close()
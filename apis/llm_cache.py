@@ -0,0 +1,118 @@
+r"""
+Persistent, content-addressed cache for LLM responses (SQLite).
+
+    cache = ResponseCache("llm_cache.sqlite", ttl=7 * 24 * 3600, max_bytes=1 << 30)
+    key = cache.key("openai", "gpt-4", messages, temperature=0)
+    response = cache.get(key)
+    if response is None:
+        response = call_the_api(...)
+        cache.put(key, response)
+    print(cache.report())
+
+mode:
+    readwrite: read hits, write misses (default)
+    replay:    read only, a miss raises `CacheMiss`, for deterministic reruns
+    off:       always miss, never write
+
+the defaults can be set with the `LLM_CACHE` (path) and `LLM_CACHE_MODE` env vars
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class CacheMiss(KeyError):
+    pass
+
+
+class ResponseCache:
+    def __init__(self, path=None, ttl=None, max_bytes=None, mode=None):
+        self.path = path or os.environ.get("LLM_CACHE", "llm_cache.sqlite")
+        self.mode = mode or os.environ.get("LLM_CACHE_MODE", "readwrite")
+        assert self.mode in ("readwrite", "replay", "off"), f"unknown cache mode: {self.mode}"
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, accessed REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def key(provider, engine, messages, **params):
+        r"""
+        sha256 over a canonical json of everything that changes the answer
+        """
+        blob = json.dumps(
+            {"provider": provider, "engine": engine, "messages": messages, "params": params},
+            sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if self.mode == "off":
+            self.misses += 1
+            return None
+        row = self.conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None and self.ttl is not None and time.time() - row[1] > self.ttl:
+            if self.mode != "replay":
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            row = None
+        if row is None:
+            self.misses += 1
+            if self.mode == "replay":
+                raise CacheMiss(key)
+            return None
+        self.hits += 1
+        if self.mode != "replay":
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        if self.mode != "readwrite":
+            return
+        value = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), now, now))
+        self.evict()
+
+    def evict(self):
+        r"""
+        drop expired entries, then least recently used ones until under `max_bytes`
+        """
+        if self.ttl is not None:
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        if self.max_bytes is None:
+            return
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        to_free = total - self.max_bytes
+        keys = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            keys.append((key,))
+            to_free -= size
+            if to_free <= 0:
+                break
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        num_entries, total = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return (f"cache {self.path} ({self.mode}): {self.hits} hits, {self.misses} misses, "
+                f"hit rate {self.hit_rate():.1%}, {num_entries} entries, {total / 1e6:.1f} MB")
+
+    def close(self):
+        self.conn.close()
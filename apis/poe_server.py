@@ -1,8 +1,9 @@
-import os
-
 from poe_api_wrapper import AsyncPoeApi
 import asyncio
 
+from llm_cache import ResponseCache
+from downloader import fetch_all
+
 # Function to read and parse the cookies file
 def read_cookies(file_path):
     cookies = {}
@@ -29,30 +30,41 @@ tokens = {
 }
 
 async def main():
-    client = await AsyncPoeApi(tokens=tokens).create()
     bot    = "gemini_1_5_pro_128k"
 
     file_urls = [
         "https://arxiv.org/pdf/2409.20537",]
-    local_files = []
-    # download the files to `tmp_files/`
-    os.makedirs("tmp_files", exist_ok=True)
-    for file_url in file_urls:
-        if file_url.startswith("http"):
-            file_name = file_url.split("/")[-1]
-            if "arxiv" in file_url:
-                file_name = file_name + ".pdf"
-            file_path = f"tmp_files/{file_name}"
-            # wget -O file_path file_url
-            os.system(f"wget -O {file_path} {file_url}")
-            local_files.append(file_path)
+    messages = ["Summarize", "What is the best book in this field?"]
+
+    # a conversation is cached as a whole, later turns depend on earlier ones
+    cache = ResponseCache()
+    key = cache.key("poe", bot, messages, file_urls=file_urls)
+    responses = cache.get(key)
+    if responses is not None:
+        for text in responses:
+            print(text)
+        print(cache.report())
+        return
+
+    # download the files to `tmp_files/` (cached, resumable) while the client starts
+    client, local_files = await asyncio.gather(
+        AsyncPoeApi(tokens=tokens).create(),
+        fetch_all([url for url in file_urls if url.startswith("http")], cache_dir="tmp_files", max_bytes=5 << 30),
+    )
     
-    async for chunk in client.send_message(bot, "Summarize", file_path=local_files):
+    responses = [""]
+    async for chunk in client.send_message(bot, messages[0], file_path=local_files):
         print(chunk["response"], end="", flush=True)
+        responses[-1] += chunk["response"]
 
     # continue the conversation
-    message = "What is the best book in this field?"
-    async for chunk in client.send_message(bot=bot, message=message, chatCode=chunk["chatCode"]):
-        print(chunk["response"], end='', flush=True)
+    for message in messages[1:]:
+        responses.append("")
+        async for chunk in client.send_message(bot=bot, message=message, chatCode=chunk["chatCode"]):
+            print(chunk["response"], end='', flush=True)
+            responses[-1] += chunk["response"]
+
+    cache.put(key, responses)
+    print(cache.report())
 
 asyncio.run(main())
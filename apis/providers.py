@@ -0,0 +1,326 @@
+r"""
+One async layer over the LLM providers (OpenAI-compatible HTTP, Gemini, Poe).
+
+- a single pooled `aiohttp` session is shared by every HTTP provider
+- cookies are read once, clients are initialized once and reused across requests
+- `ProviderRouter` ranks providers by latency and error rate (EWMA), fails
+  over to the next one on errors, and can fan a request out to several
+  providers and keep the first answer
+
+pip install aiohttp click gemini_webapi poe-api-wrapper
+"""
+
+import asyncio
+import functools
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+import click
+
+from llm_cache import ResponseCache
+
+
+class ProviderError(RuntimeError):
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def load_cookies(file_path):
+    r"""
+    netscape cookies.txt -> {name: value}, shared by the Gemini and Poe providers
+    """
+    cookies = {}
+    with open(file_path, "r") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.strip().split("\t")
+            if len(fields) >= 7:
+                cookies[fields[5]] = fields[6]
+    return cookies
+
+
+def to_prompt(messages):
+    if len(messages) == 1:
+        return messages[0]["content"]
+    return "\n\n".join(f"{message['role']}: {message['content']}" for message in messages)
+
+
+class OpenAIProvider:
+    r"""
+    any OpenAI-compatible chat completion endpoint
+    """
+    def __init__(self, name, session, api_base, model, api_key=None):
+        self.name = name
+        self.session = session
+        self.url = api_base.rstrip("/") + "/chat/completions"
+        self.model = model
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+
+    async def complete(self, messages, **params):
+        payload = {"model": self.model, "messages": messages, **params}
+        async with self.session.post(self.url, json=payload, headers=self.headers) as response:
+            body = await response.json(content_type=None)
+            if response.status >= 400:
+                raise ProviderError(f"{self.name}: HTTP {response.status} {body}")
+        return body["choices"][0]["message"]["content"]
+
+    async def close(self):
+        pass
+
+
+class GeminiProvider:
+    def __init__(self, name="gemini", cookies_file="cookies.txt"):
+        self.name = name
+        self.cookies_file = cookies_file
+        self.client = None
+        self.lock = asyncio.Lock()
+
+    async def get_client(self):
+        # `GeminiClient.init` is slow, run it once and reuse the client
+        async with self.lock:
+            if self.client is None:
+                from gemini_webapi import GeminiClient
+                cookies = load_cookies(self.cookies_file)
+                if not cookies.get("__Secure-1PSID"):
+                    raise ProviderError(f"__Secure-1PSID cookie not found in {self.cookies_file}")
+                client = GeminiClient(cookies["__Secure-1PSID"], cookies.get("__Secure-1PSIDTS", ""), proxies=None)
+                await client.init(timeout=30, auto_close=False, close_delay=300, auto_refresh=True)
+                self.client = client
+        return self.client
+
+    async def complete(self, messages, **params):
+        client = await self.get_client()
+        response = await client.generate_content(to_prompt(messages))
+        return response.text
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+
+
+class PoeProvider:
+    def __init__(self, name="poe", bot="gemini_1_5_pro_128k", cookies_file="cookies.txt"):
+        self.name = name
+        self.bot = bot
+        self.cookies_file = cookies_file
+        self.client = None
+        self.lock = asyncio.Lock()
+
+    async def get_client(self):
+        async with self.lock:
+            if self.client is None:
+                from poe_api_wrapper import AsyncPoeApi
+                cookies = load_cookies(self.cookies_file)
+                tokens = {"p-b": cookies.get("p-b"), "p-lat": cookies.get("p-lat")}
+                self.client = await AsyncPoeApi(tokens=tokens).create()
+        return self.client
+
+    async def complete(self, messages, **params):
+        client = await self.get_client()
+        text = ""
+        async for chunk in client.send_message(self.bot, to_prompt(messages), **params):
+            text += chunk["response"]
+        return text
+
+    async def close(self):
+        pass
+
+
+class ProviderRouter:
+    def __init__(self, providers, cache=None, alpha=0.2, error_penalty=10.0, failure_latency=5.0):
+        self.providers = {provider.name: provider for provider in providers}
+        self.cache = cache
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.failure_latency = failure_latency
+        self.stats = {
+            name: {"latency": None, "error_rate": 0.0, "requests": 0, "errors": 0}
+            for name in self.providers
+        }
+
+    def score(self, name):
+        stats = self.stats[name]
+        # providers that were never tried go first
+        if stats["latency"] is None:
+            return 0.0
+        return stats["latency"] * (1 + self.error_penalty * stats["error_rate"])
+
+    def ranked(self):
+        return sorted(self.providers, key=self.score)
+
+    def _update(self, name, latency, failed):
+        stats = self.stats[name]
+        stats["requests"] += 1
+        stats["errors"] += failed
+        stats["error_rate"] += self.alpha * (failed - stats["error_rate"])
+        # a failure counts as a slow sample (at least `failure_latency`, like a timeout),
+        # otherwise a provider that never succeeds keeps the "untried" score forever
+        if failed:
+            latency = max(latency, self.failure_latency)
+        prev = stats["latency"]
+        stats["latency"] = latency if prev is None else prev + self.alpha * (latency - prev)
+
+    async def _call(self, name, messages, **params):
+        start = time.perf_counter()
+        try:
+            text = await self.providers[name].complete(messages, **params)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._update(name, time.perf_counter() - start, True)
+            raise
+        self._update(name, time.perf_counter() - start, False)
+        return name, text
+
+    async def complete(self, messages, fan_out=1, **params):
+        r"""
+        try providers best-first, `fan_out` at a time, return the first answer
+        Returns:
+            (provider name, text)
+        """
+        if self.cache is not None:
+            key = self.cache.key("router", sorted(self.providers), messages, **params)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return tuple(cached)
+
+        order = self.ranked()
+        errors = []
+        while order:
+            group, order = order[:fan_out], order[fan_out:]
+            tasks = [asyncio.ensure_future(self._call(name, messages, **params)) for name in group]
+            try:
+                for future in asyncio.as_completed(tasks):
+                    try:
+                        result = await future
+                    except Exception as e:
+                        errors.append(f"{e}")
+                        continue
+                    if self.cache is not None:
+                        self.cache.put(key, list(result))
+                    return result
+            finally:
+                for task in tasks:
+                    task.cancel()
+        raise ProviderError(f"all providers failed: {errors}")
+
+    def report(self):
+        lines = []
+        for name in self.ranked():
+            stats = self.stats[name]
+            latency = f"{stats['latency'] * 1000:.0f} ms" if stats["latency"] is not None else "-"
+            lines.append(f"{name:<12} requests {stats['requests']:>5}  errors {stats['errors']:>4}  "
+                         f"error rate {stats['error_rate']:.2f}  latency {latency}")
+        return "\n".join(lines)
+
+    async def close(self):
+        for provider in self.providers.values():
+            await provider.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+def make_session(limit=64):
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=limit, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(total=300),
+    )
+
+
+async def start_stand_in(latency, error_rate, seed=0):
+    r"""
+    local OpenAI-compatible stand-in server, returns (runner, api_base)
+    """
+    rng = random.Random(seed)
+
+    async def handle(request):
+        body = await request.json()
+        await asyncio.sleep(latency * rng.uniform(0.5, 1.5))
+        if rng.random() < error_rate:
+            return web.json_response({"error": {"message": "overloaded"}}, status=503)
+        content = body["messages"][-1]["content"]
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": f"echo: {content}"}}]})
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/v1"
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--prompt", "-p", type=str, required=True)
+@click.option("--providers", type=str, default="gemini,poe", help="comma separated: openai,gemini,poe")
+@click.option("--api-base", type=str, default="https://api.openai.com/v1")
+@click.option("--api-key", type=str, envvar="OPENAI_API_KEY", default=None)
+@click.option("--model", type=str, default="gpt-4")
+@click.option("--cookies-file", type=str, default="cookies.txt")
+@click.option("--fan-out", type=int, default=1)
+def ask(prompt, providers, api_base, api_key, model, cookies_file, fan_out):
+    async def run():
+        async with make_session() as session:
+            candidates = {
+                "openai": lambda: OpenAIProvider("openai", session, api_base, model, api_key),
+                "gemini": lambda: GeminiProvider(cookies_file=cookies_file),
+                "poe": lambda: PoeProvider(cookies_file=cookies_file),
+            }
+            async with ProviderRouter([candidates[name]() for name in providers.split(",")], cache=ResponseCache()) as router:
+                name, text = await router.complete([{"role": "user", "content": prompt}], fan_out=fan_out)
+                print(f"[{name}] {text}")
+    asyncio.run(run())
+
+
+@cli.command()
+@click.option("--num-requests", type=int, default=200)
+@click.option("--concurrency", type=int, default=16)
+@click.option("--fan-out", type=int, default=1)
+def selftest(num_requests, concurrency, fan_out):
+    r"""
+    route requests over local stand-in servers (fast, slow, flaky, down)
+    """
+    async def run():
+        servers = [await start_stand_in(latency, error_rate, seed=i)
+                   for i, (latency, error_rate) in enumerate([(0.02, 0.0), (0.2, 0.0), (0.02, 0.5), (0.02, 1.0)])]
+        names = ["fast", "slow", "flaky", "down"]
+        semaphore = asyncio.Semaphore(concurrency)
+        async with make_session() as session:
+            providers = [OpenAIProvider(name, session, api_base, "mock") for name, (_, api_base) in zip(names, servers)]
+            async with ProviderRouter(providers) as router:
+                async def one(i):
+                    async with semaphore:
+                        return await router.complete([{"role": "user", "content": f"request {i}"}], fan_out=fan_out)
+
+                start = time.perf_counter()
+                results = await asyncio.gather(*[one(i) for i in range(num_requests)])
+                elapsed = time.perf_counter() - start
+                assert all(text == f"echo: request {i}" for i, (_, text) in enumerate(results))
+                print(f"{num_requests} requests in {elapsed:.2f}s ({num_requests / elapsed:.1f} requests/s)")
+                print(router.report())
+        for runner, _ in servers:
+            await runner.cleanup()
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    r"""
+    Command:
+        python apis/providers.py selftest
+        python apis/providers.py ask -p "hi" --providers gemini,poe
+        python apis/providers.py ask -p "hi" --providers openai,gemini --fan-out 2
+    """
+    cli()
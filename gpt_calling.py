@@ -1,14 +1,31 @@
 import openai
 import time
 
+import asyncio
+import json
+import os
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-def call_openai_completion(engine, messages):
+import click
+
+from apis.llm_cache import ResponseCache
+
+
+def call_openai_completion(engine, messages, cache=None):
+    if cache is not None:
+        key = cache.key("openai", engine, messages)
+        response = cache.get(key)
+        if response is not None:
+            return response
     while True:
         try:
             response = openai.ChatCompletion.create(
                 engine=engine,
                 messages=messages,
             )
+            if cache is not None:
+                cache.put(key, response)
             return response
         except openai.error.RateLimitError:
             print("RateLimitError, retrying...")
@@ -19,6 +36,196 @@ def call_openai_completion(engine, messages):
             exit(-1)
 
 
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+
+class TokenBucket:
+    r"""
+    async token bucket, `rate` tokens per minute and at most `capacity`
+    (one minute worth by default) in the bucket
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate / 60.0
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+def estimate_tokens(messages, max_tokens=None):
+    # ~4 characters per token, good enough for rate limiting
+    num_chars = sum(len(message["content"]) for message in messages)
+    return num_chars // 4 + (max_tokens or 512)
+
+
+async def call_openai_completion_async(engine, messages, request_limiter=None, token_limiter=None,
+                                       max_retries=8, base_delay=1.0, max_delay=60.0, cache=None, **kwargs):
+    r"""
+    async version of `call_openai_completion`, retries transient errors with
+    exponential backoff and full jitter instead of a flat sleep, and raises
+    (instead of `exit`) on anything else
+    """
+    if cache is not None:
+        key = cache.key("openai", engine, messages, **kwargs)
+        response = cache.get(key)
+        if response is not None:
+            return response
+    for attempt in range(max_retries + 1):
+        if request_limiter is not None:
+            await request_limiter.acquire(1)
+        if token_limiter is not None:
+            await token_limiter.acquire(estimate_tokens(messages, kwargs.get("max_tokens")))
+        try:
+            response = await openai.ChatCompletion.acreate(
+                engine=engine,
+                messages=messages,
+                **kwargs,
+            )
+            if cache is not None:
+                cache.put(key, response)
+            return response
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            print(f"{type(e).__name__}, retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+
+def load_done_ids(output_path):
+    done = set()
+    if os.path.exists(output_path):
+        with open(output_path, "r") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if "error" not in record:
+                        done.add(record["id"])
+    return done
+
+
+def to_messages(record, prompt_key, system):
+    if "messages" in record:
+        return record["messages"]
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": record[prompt_key]},
+    ]
+
+
+async def run_batch(input_path, output_path, engine, concurrency=16, rpm=60, tpm=90000,
+                    prompt_key="prompt", id_key="id", system="You are a senior researcher on computer vision.", **kwargs):
+    r"""
+    run every prompt of a JSONL file through the LLM with at most `concurrency`
+    requests in flight, results are appended to `output_path` as they finish
+    (in completion order), so an interrupted run resumes where it stopped
+    """
+    request_limiter = TokenBucket(rpm)
+    token_limiter = TokenBucket(tpm)
+    done_ids = load_done_ids(output_path)
+    queue = asyncio.Queue(maxsize=2 * concurrency)
+    stats = {"ok": 0, "error": 0, "skipped": 0}
+
+    async def producer():
+        with open(input_path, "r") as f:
+            for idx, line in enumerate(f):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                record_id = record.get(id_key, idx)
+                if record_id in done_ids:
+                    stats["skipped"] += 1
+                    continue
+                await queue.put((record_id, record))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def worker(out):
+        while (item := await queue.get()) is not None:
+            record_id, record = item
+            start = time.time()
+            try:
+                response = await call_openai_completion_async(
+                    engine, to_messages(record, prompt_key, system),
+                    request_limiter=request_limiter, token_limiter=token_limiter, **kwargs)
+                result = {
+                    "id": record_id,
+                    "response": response["choices"][0]["message"]["content"],
+                    "usage": dict(response.get("usage", {})),
+                }
+                stats["ok"] += 1
+            except Exception as e:
+                result = {"id": record_id, "error": f"{type(e).__name__}: {e}"}
+                stats["error"] += 1
+            result["latency"] = time.time() - start
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+
+    start = time.time()
+    with open(output_path, "a") as out:
+        await asyncio.gather(producer(), *[worker(out) for _ in range(concurrency)])
+    elapsed = time.time() - start
+    print(f"{stats['ok']} ok, {stats['error']} errors, {stats['skipped']} skipped in {elapsed:.1f}s "
+          f"({stats['ok'] / max(elapsed, 1e-9):.2f} requests/s)")
+    return stats
+
+
+class MockCompletionHandler(BaseHTTPRequestHandler):
+    r"""
+    stand-in for the chat completion endpoint, echoes the last message after
+    `latency` seconds and answers 429 with probability `error_rate`
+    """
+    latency = 0.2
+    error_rate = 0.1
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self._reply(429, {"error": {"message": "Rate limit reached", "type": "requests"}})
+            return
+        content = body["messages"][-1]["content"]
+        self._reply(200, {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": f"echo: {content}"}}],
+            "usage": {"prompt_tokens": len(content) // 4, "completion_tokens": len(content) // 4,
+                      "total_tokens": len(content) // 2},
+        })
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
 def main():
     llm_engine = "gpt-4"
     prompt = """I want you to help me make the paragraph shorter. Here is a paragraph of the paper (in latex), please polish and compress it without changing the meaning or losing the details. {paragraph}"""
@@ -34,14 +241,75 @@ def main():
         {"role": "system", "content": "You are a senior researcher on computer vision."},
         {"role": "user", "content": prompt}
     ]
-    response = call_openai_completion(engine=llm_engine, messages=messages)
-    response_message = response["choices"][0]["message"]
-    response_message = response_message.to_dict()["content"]
+    cache = ResponseCache()
+    response = call_openai_completion(engine=llm_engine, messages=messages, cache=cache)
+    response_message = response["choices"][0]["message"]["content"]
 
     print(paragraph)
     print()
     print(response_message)
+    print(cache.report())
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
+def cli(ctx):
+    r"""
+    without a sub-command, run the paragraph polishing demo in `main`
+    """
+    if ctx.invoked_subcommand is None:
+        main()
+
+
+@cli.command()
+@click.option("--input", "-i", "input_path", type=click.Path(exists=True), required=True, help="JSONL of prompts")
+@click.option("--output", "-o", "output_path", type=click.Path(), required=True, help="JSONL of responses")
+@click.option("--engine", type=str, default="gpt-4")
+@click.option("--concurrency", type=int, default=16)
+@click.option("--rpm", type=int, default=60, help="requests per minute")
+@click.option("--tpm", type=int, default=90000, help="tokens per minute")
+@click.option("--prompt-key", type=str, default="prompt")
+@click.option("--id-key", type=str, default="id")
+@click.option("--api-base", type=str, default=None, help="e.g. http://127.0.0.1:8000/v1 for `mock-server`")
+@click.option("--cache", "cache_path", type=str, default=None, help="sqlite response cache")
+@click.option("--cache-mode", type=click.Choice(["readwrite", "replay", "off"]), default="readwrite")
+def batch(input_path, output_path, engine, concurrency, rpm, tpm, prompt_key, id_key, api_base, cache_path, cache_mode):
+    r"""
+    run a JSONL file of prompts concurrently, each line has `messages` or `<prompt-key>`
+    """
+    if api_base is not None:
+        openai.api_type = "open_ai"
+        openai.api_base = api_base
+        openai.api_key = openai.api_key or "mock"
+    cache = ResponseCache(cache_path, mode=cache_mode) if cache_path is not None else None
+    asyncio.run(run_batch(input_path, output_path, engine, concurrency=concurrency, rpm=rpm, tpm=tpm,
+                          prompt_key=prompt_key, id_key=id_key, cache=cache))
+    if cache is not None:
+        print(cache.report())
+
+
+@cli.command()
+@click.option("--port", type=int, default=8000)
+@click.option("--latency", type=float, default=0.2)
+@click.option("--error-rate", type=float, default=0.1)
+def mock_server(port, latency, error_rate):
+    r"""
+    local stand-in for the completion API, to test `batch` without a key
+    """
+    MockCompletionHandler.latency = latency
+    MockCompletionHandler.error_rate = error_rate
+    print(f"Serving mock completions on http://127.0.0.1:{port}/v1")
+    ThreadingHTTPServer(("127.0.0.1", port), MockCompletionHandler).serve_forever()
 
 
 if __name__ == '__main__':
-    main()
+    r"""
+    Command:
+        python gpt_calling.py
+        python gpt_calling.py batch -i prompts.jsonl -o responses.jsonl --concurrency 32 --rpm 500
+
+        # against the local mock server
+        python gpt_calling.py mock-server --port 8000
+        python gpt_calling.py batch -i requests.jsonl -o responses.jsonl --prompt-key body --id-key request_id --api-base http://127.0.0.1:8000/v1
+    """
+    cli()
@@ -1,8 +1,17 @@
 import os
 import glob
 
+import asyncio
 import click
+import fnmatch
+import hashlib
+import io
+import json
 import re
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 @click.group()
@@ -10,54 +19,564 @@ def cli():
     pass
 
 
+DEFAULT_EXCLUDES = [
+    ".git", "__pycache__", ".venv", "venv", "env", "node_modules", "site-packages",
+    "build", "dist", ".tox", ".nox", ".mypy_cache", ".pytest_cache", "*.egg-info",
+]
+
+
+def git_visible_files(root):
+    r"""
+    files git does not ignore (tracked + untracked), None outside a git repo
+    """
+    try:
+        out = subprocess.run(
+            ["git", "-C", root, "ls-files", "-co", "--exclude-standard", "-z"],
+            capture_output=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return {os.path.normpath(os.path.join(root, path)) for path in out.decode().split("\0") if path}
+
+
+def load_gitignore(root):
+    r"""
+    fallback when git is not available, plain patterns of `root/.gitignore`
+    (negations are not supported)
+    """
+    path = os.path.join(root, ".gitignore")
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        lines = [line.strip() for line in f]
+    return [line.strip("/") for line in lines if line and not line.startswith(("#", "!"))]
+
+
+def is_excluded(rel_path, patterns):
+    name = os.path.basename(rel_path)
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern) for pattern in patterns)
+
+
+def walk_files(root, suffix=".py", excludes=(), use_gitignore=True, max_file_size=None):
+    r"""
+    os.walk that prunes excluded directories instead of descending into them
+    """
+    patterns = list(DEFAULT_EXCLUDES) + list(excludes)
+    visible = git_visible_files(root) if use_gitignore else None
+    if use_gitignore and visible is None:
+        patterns += load_gitignore(root)
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        dirnames[:] = [d for d in dirnames if not is_excluded(os.path.normpath(os.path.join(rel_dir, d)), patterns)]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if not name.endswith(suffix) or is_excluded(os.path.normpath(os.path.join(rel_dir, name)), patterns):
+                continue
+            if visible is not None and os.path.normpath(path) not in visible:
+                continue
+            if max_file_size is not None and os.path.getsize(path) > max_file_size:
+                print(f"Skipping {path} (larger than {max_file_size} bytes)")
+                continue
+            files.append(path)
+    return sorted(files)
+
+
+def render_python(file, content):
+    return f"The file `{file}` is\n\n```python\n{content}\n```\n\n".encode("utf-8")
+
+
+def read_block(file):
+    with open(file, "rb") as f:
+        data = f.read()
+    return hashlib.sha256(data).hexdigest(), render_python(file, data.decode("utf-8", errors="replace"))
+
+
+class PartWriter:
+    r"""
+    write blocks to `output`, or to `name.part000.ext`, ... capped at
+    `max_part_bytes` each (a block is never split across parts)
+    """
+    def __init__(self, output, max_part_bytes=None):
+        self.output = output
+        self.max_part_bytes = max_part_bytes
+        self.parts = []
+        self.f = None
+        self.offset = 0
+
+    def part_name(self, idx):
+        if self.max_part_bytes is None:
+            return self.output
+        stem, ext = os.path.splitext(self.output)
+        return f"{stem}.part{idx:03d}{ext}"
+
+    def write(self, block):
+        if self.f is None or (self.max_part_bytes is not None and self.offset
+                              and self.offset + len(block) > self.max_part_bytes):
+            self.next_part()
+        offset = self.offset
+        self.f.write(block)
+        self.offset += len(block)
+        return len(self.parts) - 1, offset
+
+    def next_part(self):
+        if self.f is not None:
+            self.f.close()
+        self.parts.append(self.part_name(len(self.parts)))
+        self.f = open(self.parts[-1] + ".tmp", "wb")
+        self.offset = 0
+
+    def close(self):
+        if self.f is None:
+            self.next_part()
+        self.f.close()
+        for part in self.parts:
+            os.replace(part + ".tmp", part)
+
+
 @cli.command()
 @click.option("--input", "-i", type=click.Path(exists=True), required=True)
-def merge_python(input):
+@click.option("--output", "-o", type=str, default="gpt-4-turbo.md")
+@click.option("--exclude", "-e", multiple=True, help="extra file/dir glob patterns to skip")
+@click.option("--no-gitignore", is_flag=True, help="also merge files ignored by git")
+@click.option("--max-file-size", type=int, default=1 << 20, help="skip larger (generated) files")
+@click.option("--max-part-bytes", type=int, default=None, help="shard the output into parts of this size")
+@click.option("--num-threads", type=int, default=16)
+def merge_python(input, output, exclude, no_gitignore, max_file_size, max_part_bytes, num_threads):
     r"""
     the input is the directory of the python files, merge to
     a markdown file for gpt-4-turbo analysis
+
+    files are read in parallel threads and streamed to the output, a
+    manifest (`<output>.manifest.json`) remembers mtime/size/sha256 and the
+    location of every block, so on the next run unchanged files are copied
+    from the previous output instead of being read again
+    """
+    python_files = walk_files(input, ".py", exclude, not no_gitignore, max_file_size)
+
+    manifest_path = output + ".manifest.json"
+    old = {"parts": [], "files": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            old = json.load(f)
+        if not all(os.path.exists(part) for part in old["parts"]):
+            old = {"parts": [], "files": {}}
+    old_parts = {}
+
+    def old_block(entry):
+        idx = entry["part"]
+        if idx not in old_parts:
+            old_parts[idx] = open(old["parts"][idx], "rb")
+        old_parts[idx].seek(entry["offset"])
+        return old_parts[idx].read(entry["length"])
+
+    def unchanged(file, stat):
+        entry = old["files"].get(file)
+        return entry is not None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size
+
+    writer = PartWriter(output, max_part_bytes)
+    files = {}
+    num_reused = 0
+    with ThreadPoolExecutor(num_threads) as pool:
+        # bounded look-ahead keeps memory flat while keeping the threads busy
+        pending = deque()
+        queue = iter(python_files)
+
+        def submit():
+            for file in queue:
+                stat = os.stat(file)
+                pending.append((file, stat, None if unchanged(file, stat) else pool.submit(read_block, file)))
+                if len(pending) >= 4 * num_threads:
+                    break
+
+        submit()
+        while pending:
+            file, stat, future = pending.popleft()
+            if future is None:
+                sha, block = old["files"][file]["sha256"], old_block(old["files"][file])
+                num_reused += 1
+            else:
+                sha, block = future.result()
+            part, offset = writer.write(block)
+            files[file] = {
+                "mtime": stat.st_mtime, "size": stat.st_size, "sha256": sha,
+                "part": part, "offset": offset, "length": len(block),
+            }
+            submit()
+    for f in old_parts.values():
+        f.close()
+    writer.close()
+
+    # parts left over from a previous run with more parts
+    for part in set(old["parts"]) - set(writer.parts):
+        os.remove(part)
+    with open(manifest_path, "w") as f:
+        json.dump({"input": input, "parts": writer.parts, "files": files}, f, indent=1)
+    print(f"Merged {len(files)} files ({num_reused} unchanged) into {', '.join(writer.parts)}")
+
+
+
+INPUT_PATTERN = re.compile(r"\\(input|include)\{([^}]+)\}")
+COMMENT_PATTERN = re.compile(r"(?<!\\)(?:\\\\)*%")
+
+
+def strip_comment(line):
+    r"""
+    drop a trailing `% comment` but keep the `%` (it also eats the newline),
+    `\%` is a literal percent sign, `\\%` a line break followed by a comment
     """
-    python_files = glob.glob(os.path.join(input, "**/*.py"), recursive=True)
-    python_files = sorted(python_files)
+    match = COMMENT_PATTERN.search(line)
+    if match is None:
+        return line
+    return line[:match.end()] + "\n"
+
 
-    with open("gpt-4-turbo.md", "w") as f:
-        for file in python_files:
-            with open(file, "r") as py:
-                f.write(f"The file `{file}` is\n\n```python\n{py.read()}\n```\n\n")
+class LatexFlattener:
+    r"""
+    expand `\input{}` / `\include{}` recursively in a single pass, writing to
+    `out` as it goes. included files are read once and cached, comments are
+    stripped on the way
+
+    with a build cache, the include graph, per-file hashes and the expansion
+    of every file are kept between runs, and only subtrees containing a
+    changed file are expanded again
+    """
+    def __init__(self, directory, cache_path=None):
+        self.directory = directory
+        self.cache = {}
+        self.cache_path = cache_path
+        # path -> {"mtime", "size", "sha256", "deps", "expansion"}, None if missing
+        self.build = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                build = json.load(f)
+            if build.get("directory") == directory:
+                self.build = build["files"]
+        self.fresh = {}
+        self.rebuilt = set()
+        self.num_expanded = 0
 
+    def save(self):
+        if self.cache_path is not None:
+            with open(self.cache_path + ".tmp", "w") as f:
+                json.dump({"directory": self.directory, "files": self.build}, f)
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+
+    def resolve(self, filename):
+        if not os.path.splitext(filename)[1]:
+            filename += ".tex"
+        return os.path.normpath(os.path.join(self.directory, filename))
+
+    def lines(self, path):
+        if path not in self.cache:
+            with open(path, "r") as f:
+                self.cache[path] = f.readlines()
+        return self.cache[path]
+
+    def is_fresh(self, path):
+        r"""
+        the cached expansion of `path` is valid if neither the file nor any
+        file it includes (recursively) changed since the last run
+        """
+        if path in self.fresh:
+            return self.fresh[path]
+        self.fresh[path] = False
+        entry = self.build.get(path, False)
+        if entry is False:
+            return False
+        if entry is None:
+            # was missing last time, still fine if it is still missing
+            self.fresh[path] = not os.path.exists(path)
+            return self.fresh[path]
+        if not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        if (stat.st_mtime, stat.st_size) != (entry["mtime"], entry["size"]):
+            with open(path, "rb") as f:
+                if hashlib.sha256(f.read()).hexdigest() != entry["sha256"]:
+                    return False
+            entry["mtime"], entry["size"] = stat.st_mtime, stat.st_size
+        # a dep expanded again in this run invalidates the copy embedded here
+        self.fresh[path] = all(self.is_fresh(dep) and dep not in self.rebuilt for dep in entry["deps"])
+        return self.fresh[path]
+
+    def flatten(self, path, out, stack=()):
+        if path in stack:
+            raise click.ClickException(f"Circular \\input: {' -> '.join(stack + (path,))}")
+        if self.cache_path is None:
+            self._flatten(path, out, stack + (path,))
+            return
+        if not self.is_fresh(path):
+            # expand into a buffer to cache this subtree, then pass it on
+            buffer = io.StringIO()
+            deps = self._flatten(path, buffer, stack + (path,))
+            stat = os.stat(path)
+            with open(path, "rb") as f:
+                sha = hashlib.sha256(f.read()).hexdigest()
+            self.build[path] = {
+                "mtime": stat.st_mtime, "size": stat.st_size, "sha256": sha,
+                "deps": deps, "expansion": buffer.getvalue(),
+            }
+            for dep in deps:
+                if not os.path.exists(dep):
+                    self.build[dep] = None
+            self.fresh[path] = True
+            self.rebuilt.add(path)
+        out.write(self.build[path]["expansion"])
+
+    def _flatten(self, path, out, stack):
+        self.num_expanded += 1
+        deps = []
+        for line in self.lines(path):
+            # remove comments (each line starts with %)
+            if line.lstrip().startswith("%"):
+                continue
+            line = strip_comment(line)
+            pos = 0
+            for match in INPUT_PATTERN.finditer(line):
+                filename = self.resolve(match.group(2).strip())
+                deps.append(filename)
+                if not os.path.exists(filename):
+                    print(f"Warning: {filename} not found, keeping `{match.group(0)}`")
+                    continue
+                out.write(line[pos:match.start()])
+                if match.group(1) == "include":
+                    out.write("\\clearpage\n")
+                self.flatten(filename, out, stack)
+                if match.group(1) == "include":
+                    out.write("\\clearpage\n")
+                pos = match.end()
+            out.write(line[pos:])
+        return deps
+
+    def watched_files(self):
+        r"""
+        files of the include graph (including missing ones) after a build
+        """
+        return sorted(self.build)
+
+
+def build_latex(input, output, cache_path=None):
+    start = time.time()
+    flattener = LatexFlattener(os.path.dirname(input), cache_path)
+    try:
+        with open(output + ".tmp", "w") as f:
+            flattener.flatten(os.path.normpath(input), f)
+        os.replace(output + ".tmp", output)
+    except BaseException:
+        if os.path.exists(output + ".tmp"):
+            os.remove(output + ".tmp")
+        raise
+    flattener.save()
+    print(f"Saved {output}, expanded {flattener.num_expanded} files in {(time.time() - start) * 1000:.1f} ms")
+    return flattener
 
 
 @cli.command()
 @click.option("--input", "-i", type=click.Path(exists=True), required=True)
-def merge_latex(input):
+@click.option("--output", "-o", type=str, default="merged.tex")
+@click.option("--no-cache", is_flag=True, help="don't use the build cache (`<output>.cache.json`)")
+@click.option("--watch", is_flag=True, help="rebuild whenever a file of the include graph changes")
+@click.option("--interval", type=float, default=0.5, help="polling interval of --watch in seconds")
+def merge_latex(input, output, no_cache, watch, interval):
     r"""
     the input is the file of `main.tex`, replace the `input{}` 
     with the content of the file, save as `merged.tex`
 
     ```
     python parse_for_gpt.py merge-latex -i cvpr2024/main.tex
+    python parse_for_gpt.py merge-latex -i cvpr2024/main.tex --watch
     ```
     """
+    cache_path = None if no_cache else output + ".cache.json"
+    flattener = build_latex(input, output, cache_path)
+    if not watch:
+        return
+
+    def mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def snapshot(paths):
+        return {path: mtime(path) for path in paths}
+
+    # the watched files are refreshed after every build, so new includes are picked up
+    paths = flattener.watched_files() or [input]
+    state = snapshot(paths)
+    print(f"Watching {len(paths)} files, Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(interval)
+            current = snapshot(paths)
+            if current == state:
+                continue
+            try:
+                flattener = build_latex(input, output, cache_path)
+            except (click.ClickException, OSError) as e:
+                # e.g. a circular \input, or a file caught mid-save by an editor; keep the
+                # pre-build snapshot so the next change (or the file coming back) rebuilds
+                print(f"Build failed: {e.format_message() if isinstance(e, click.ClickException) else e}")
+                state = current
+                continue
+            paths = flattener.watched_files() or [input]
+            state = snapshot(paths)
+    except KeyboardInterrupt:
+        pass
+
+
+def count_tokens(text, encoding="cl100k_base"):
+    r"""
+    exact with `tiktoken` (pip install tiktoken), ~4 characters per token otherwise
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return len(text) // 4 + 1
+    return len(tiktoken.get_encoding(encoding).encode(text, disallowed_special=()))
+
+
+BOUNDARIES = {
+    ".py": re.compile(r"^(?=(?:async\s+def|def|class)\s)", re.MULTILINE),
+    ".tex": re.compile(r"^(?=\\(?:chapter|section|subsection)\*?\{)", re.MULTILINE),
+    ".md": re.compile(r"^(?=#{1,3}\s)", re.MULTILINE),
+}
+
+
+def read_units(path):
+    r"""
+    split a file into units at natural boundaries (functions and classes,
+    sections, headings, pdf pages), each unit is (title, text)
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        import fitz  # PyMuPDF
+        with fitz.open(path) as doc:
+            return [(f"{path} page {i + 1}", page.get_text()) for i, page in enumerate(doc)]
+    with open(path, "r", errors="ignore") as f:
+        text = f.read()
+    pattern = BOUNDARIES.get(ext, re.compile(r"(?<=\n\n)"))
+    parts = [part for part in pattern.split(text) if part.strip()]
+    return [(path, part) for part in parts]
+
+
+def chunk_units(units, max_tokens):
+    r"""
+    greedily pack units into chunks of at most `max_tokens`, a unit that is
+    too large on its own is split by lines
+    """
+    chunks, current, current_tokens = [], [], 0
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            chunks.append("".join(current))
+        current, current_tokens = [], 0
+
+    for title, text in units:
+        text = f"`{title}`:\n{text}\n"
+        tokens = count_tokens(text)
+        if tokens > max_tokens:
+            flush()
+            for line in text.splitlines(keepends=True):
+                line_tokens = count_tokens(line)
+                if current_tokens + line_tokens > max_tokens:
+                    flush()
+                current.append(line)
+                current_tokens += line_tokens
+            flush()
+            continue
+        if current_tokens + tokens > max_tokens:
+            flush()
+        current.append(text)
+        current_tokens += tokens
+    flush()
+    return chunks
+
+
+def collect_files(input, suffixes):
+    if os.path.isfile(input):
+        return [input]
+    files = []
+    for suffix in suffixes:
+        files += glob.glob(os.path.join(input, f"**/*{suffix}"), recursive=True)
+    return sorted(files)
+
+
+async def map_reduce(chunks, question, engine, concurrency, max_tokens, cache):
+    r"""
+    answer `question` for every chunk concurrently, then merge the partial
+    answers group by group (each group within `max_tokens`) until one is left.
+    every call goes through the response cache, so a rerun only sends the
+    chunks (and merges) whose content changed
+    """
+    from gpt_calling import call_openai_completion_async, TokenBucket
+
+    semaphore = asyncio.Semaphore(concurrency)
+    request_limiter = TokenBucket(60)
+    system = "You are a senior researcher on computer vision."
+
+    async def ask(prompt):
+        messages = [{"role": "system", "content": system}, {"role": "user", "content": prompt}]
+        async with semaphore:
+            response = await call_openai_completion_async(
+                engine, messages, request_limiter=request_limiter, cache=cache)
+        return response["choices"][0]["message"]["content"]
+
+    # the prompt depends on the chunk only (no index / count), so an edit elsewhere
+    # in the input does not invalidate the cached answers of unchanged chunks
+    answers = await asyncio.gather(*[
+        ask(f"{question}\n\nThis is one part of a longer input:\n\n{chunk}")
+        for chunk in chunks])
+
+    level = 0
+    while len(answers) > 1:
+        level += 1
+        groups = chunk_units([(f"partial answer {i + 1}", answer) for i, answer in enumerate(answers)], max_tokens)
+        if len(groups) >= len(answers):
+            # each answer fills a group on its own (or is split over several), merge pairs to make progress
+            groups = ["\n".join(answers[i:i + 2]) for i in range(0, len(answers), 2)]
+        print(f"merge level {level}: {len(answers)} -> {len(groups)}")
+        answers = await asyncio.gather(*[
+            ask(f"{question}\n\nMerge the following partial answers, each computed on a different "
+                f"part of the input, into one answer:\n\n{group}")
+            for group in groups])
+    return answers[0]
+
+
+@cli.command()
+@click.option("--input", "-i", type=click.Path(exists=True), required=True)
+@click.option("--question", "-q", type=str, default="Summarize the content, keep the important details.")
+@click.option("--suffixes", type=str, default=".py", help="file types to read from a directory, e.g. .py,.tex,.md,.pdf")
+@click.option("--engine", type=str, default="gpt-4")
+@click.option("--max-tokens", type=int, default=6000, help="tokens per chunk")
+@click.option("--concurrency", type=int, default=8)
+@click.option("--output", "-o", type=str, default="summary.md")
+def summarize(input, question, suffixes, engine, max_tokens, concurrency, output):
+    r"""
+    token-aware chunking + parallel map-reduce over inputs that don't fit
+    in one context window (a source tree, a thesis, long pdfs)
+
+    ```
+    python merge_file.py summarize -i src/ -q "Explain the architecture"
+    python merge_file.py summarize -i paper.pdf
+    ```
+    """
+    from apis.llm_cache import ResponseCache
+
+    units = []
+    for path in collect_files(input, suffixes.split(",")):
+        units += read_units(path)
+    chunks = chunk_units(units, max_tokens)
+    print(f"{len(units)} units -> {len(chunks)} chunks")
 
-    directory = os.path.dirname(input)
-    with open(input, "r") as f:
-        content = f.read()
-    for line in content.split("\n"):
-        pattern = re.compile(r"\\input{(.+?)}")
-        match = pattern.search(line)
-        if match:
-            filename = match.group(1)
-            if not filename.endswith(".tex"):
-                filename += ".tex"
-            filename = os.path.join(directory, filename)
-            with open(filename, "r") as f:
-                content = content.replace(line, f.read())
-
-    # remove comments (each line starts with %)
-    content = "\n".join([line for line in content.split("\n") if not line.strip().startswith("%")])
-
-    with open("merged.tex", "w") as f:
-        f.write(content)
+    cache = ResponseCache()
+    answer = asyncio.run(map_reduce(chunks, question, engine, concurrency, max_tokens, cache))
+    with open(output, "w") as f:
+        f.write(answer)
+    print(cache.report())
+    print(f"Saved to {output}")
 
 
 if __name__ == "__main__":
@@ -9,6 +9,10 @@ from glob import glob
 from PIL import Image
 
 import click
+import json
+import os
+import pickle
+import resource
 import time
 
 
@@ -21,6 +25,145 @@ def main_worker(args):
     return idx, None
 
 
+def timed_worker(args):
+    r"""
+    run `main_worker` and record when/where it ran, so that the parent
+    can tell CPU time from pickling and IPC time
+    """
+    start = time.time()
+    ret = main_worker(args)
+    end = time.time()
+    # serialization cost of sending the result back (estimate, the pool pickles again)
+    payload_bytes = len(pickle.dumps(ret))
+    pickled = time.time()
+    stats = {
+        "pid": os.getpid(),
+        "start": start,
+        "end": end,
+        "pickle_time": pickled - end,
+        "payload_bytes": payload_bytes,
+        # KB on linux, bytes on macOS
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    return ret, stats
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize_telemetry(records, wall_start, wall_end, num_cores):
+    r"""
+    records: list of worker stats, each with an extra `received` timestamp
+    taken in the parent when the result arrived
+    """
+    wall = max(wall_end - wall_start, 1e-9)
+    latency = [r["end"] - r["start"] for r in records]
+    ipc = [r["received"] - r["end"] for r in records]
+
+    per_worker = {}
+    for r in records:
+        w = per_worker.setdefault(r["pid"], {"tasks": 0, "busy": 0.0, "max_rss": 0})
+        w["tasks"] += 1
+        w["busy"] += r["end"] - r["start"]
+        w["max_rss"] = max(w["max_rss"], r["max_rss"])
+    for w in per_worker.values():
+        w["idle"] = wall - w["busy"]
+        w["utilization"] = w["busy"] / wall
+
+    # items/s in 1 second buckets, counted at the time results reach the parent
+    throughput = [0] * (int(wall) + 1)
+    for r in records:
+        throughput[min(int(r["received"] - wall_start), len(throughput) - 1)] += 1
+
+    return {
+        "num_cores": num_cores,
+        "num_tasks": len(records),
+        "wall_time": wall,
+        "items_per_sec": len(records) / wall,
+        "latency": {f"p{q}": percentile(latency, q) for q in (50, 95, 99)} | {"max": max(latency, default=0.0)},
+        "ipc_overhead": {f"p{q}": percentile(ipc, q) for q in (50, 95, 99)} | {"total": sum(ipc)},
+        "pickle_time_total": sum(r["pickle_time"] for r in records),
+        "payload_bytes_total": sum(r["payload_bytes"] for r in records),
+        "utilization": sum(w["busy"] for w in per_worker.values()) / (wall * num_cores),
+        "throughput_per_sec": throughput,
+        "workers": per_worker,
+    }
+
+
+def to_chrome_trace(records, wall_start):
+    r"""
+    open in chrome://tracing or https://ui.perfetto.dev
+    """
+    events = []
+    for i, r in enumerate(records):
+        events.append({
+            "name": "task", "ph": "X", "pid": 0, "tid": r["pid"],
+            "ts": (r["start"] - wall_start) * 1e6, "dur": (r["end"] - r["start"]) * 1e6,
+            "args": {"payload_bytes": r["payload_bytes"], "max_rss": r["max_rss"]},
+        })
+        events.append({
+            "name": "ipc", "ph": "X", "pid": 0, "tid": r["pid"],
+            "ts": (r["end"] - wall_start) * 1e6, "dur": max(r["received"] - r["end"], 0) * 1e6,
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def get_rank(rank=None):
+    if rank is not None:
+        return rank
+    return int(os.environ.get("RANK", os.environ.get("NODE_RANK", "0")))
+
+
+def get_world_size(world_size=None):
+    if world_size is not None:
+        return world_size
+    return int(os.environ.get("WORLD_SIZE", os.environ.get("NUM_NODES", "1")))
+
+
+def shard_tasks(args_list, rank, world_size):
+    r"""
+    split the task list deterministically across nodes, every node
+    must discover the same (sorted) list for the split to be consistent
+    """
+    assert 0 <= rank < world_size, f"invalid rank {rank} for world size {world_size}"
+    return args_list[rank::world_size]
+
+
+def shard_path(output_dir, rank, world_size):
+    return os.path.join(output_dir, f"shard-{rank:05d}-of-{world_size:05d}.pkl")
+
+
+def merge_list_of_list(list_of_list):
+    ret = []
+    for l in list_of_list:
+        ret.extend(l)
+    return ret
+
+
+def merge_list_of_dict(list_of_dict):
+    ret = {}
+    for d in list_of_dict:
+        ret.update(d)
+    return ret
+
+
+def merge_results(results):
+    # same semantics as `merge_results` in gpu.py, kept here so that
+    # CPU nodes do not need torch installed
+    if isinstance(results[0], dict):
+        return merge_list_of_dict(results)
+    elif isinstance(results[0], list):
+        return merge_list_of_list(results)
+    else:
+        raise NotImplementedError
+
+
 @click.group()
 def main():
     pass
@@ -28,26 +171,88 @@ def main():
 
 @main.command()
 @click.option("--num-cores", type=int, default=1)
-def benchmark(num_cores=1):
+@click.option("--rank", type=int, default=None, help="node rank, defaults to $RANK")
+@click.option("--world-size", type=int, default=None, help="number of nodes, defaults to $WORLD_SIZE")
+@click.option("--output-dir", type=str, default=None, help="write this node's result shard here")
+@click.option("--telemetry", type=str, default=None, help="save latency/throughput stats as json")
+@click.option("--trace", type=str, default=None, help="save a chrome trace (json)")
+def benchmark(num_cores=1, rank=None, world_size=None, output_dir=None, telemetry=None, trace=None):
     NUM_CORES = num_cores
-    
-    image_paths = glob("../datasets/VGPhraseCut_v0/images/*.jpg")
+    rank = get_rank(rank)
+    world_size = get_world_size(world_size)
+
+    image_paths = sorted(glob("../datasets/VGPhraseCut_v0/images/*.jpg"))
     args_list = [(idx, path) for idx, path in enumerate(image_paths)]
+    args_list = shard_tasks(args_list, rank, world_size)
 
     start_time = time.time()
 
+    results, records = [], []
     with Pool(NUM_CORES) as pool:
-        _ = list(tqdm(
-            pool.imap_unordered(main_worker, args_list), 
-            total=len(image_paths)))
+        for ret, stats in tqdm(
+                pool.imap_unordered(timed_worker, args_list), 
+                total=len(args_list)):
+            stats["received"] = time.time()
+            results.append(ret)
+            records.append(stats)
 
     end_time = time.time()
 
+    summary = summarize_telemetry(records, start_time, end_time, NUM_CORES)
+    print(f"[rank {rank}/{world_size}] {summary['items_per_sec']:.2f} items/s, "
+          f"latency p50/p95/p99: " + "/".join(f"{summary['latency'][k] * 1000:.1f}" for k in ("p50", "p95", "p99")) + " ms, "
+          f"ipc p50: {summary['ipc_overhead']['p50'] * 1000:.1f} ms, "
+          f"utilization: {summary['utilization'] * 100:.1f}%")
+    if telemetry is not None:
+        with open(telemetry, "w") as f:
+            json.dump(summary, f, indent=2)
+    if trace is not None:
+        with open(trace, "w") as f:
+            json.dump(to_chrome_trace(records, start_time), f)
+
     # to time format d/h:m:s
     elapsed_time = end_time - start_time
     elapsed_time = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
 
-    print(f"Elapsed time: {elapsed_time}")
+    print(f"[rank {rank}/{world_size}] Elapsed time: {elapsed_time}")
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        path = shard_path(output_dir, rank, world_size)
+        # write to a temp file first so that `merge` never sees a partial shard
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(dict(results), f)
+        os.replace(path + ".tmp", path)
+        print(f"[rank {rank}/{world_size}] Saved {len(results)} results to {path}")
+
+
+@main.command()
+@click.option("--output-dir", type=str, required=True)
+@click.option("--save-path", type=str, default=None)
+def merge(output_dir, save_path=None):
+    r"""
+    combine the result shards written by `benchmark --output-dir`
+    """
+    shard_files = sorted(glob(os.path.join(output_dir, "shard-*-of-*.pkl")))
+    if len(shard_files) == 0:
+        raise click.ClickException(f"No shards found in {output_dir}")
+
+    world_size = int(os.path.basename(shard_files[0]).split("-")[-1].split(".")[0])
+    expected = [shard_path(output_dir, rank, world_size) for rank in range(world_size)]
+    missing = sorted(set(expected) - set(shard_files))
+    if missing:
+        raise click.ClickException(f"Missing shards: {missing}")
+
+    results = []
+    for path in expected:
+        with open(path, "rb") as f:
+            results.append(pickle.load(f))
+    results = merge_results(results)
+
+    save_path = save_path or os.path.join(output_dir, "merged.pkl")
+    with open(save_path, "wb") as f:
+        pickle.dump(results, f)
+    print(f"Merged {len(expected)} shards ({len(results)} results) to {save_path}")
 
 
 if __name__ == "__main__":
@@ -57,5 +262,13 @@ if __name__ == "__main__":
         python parallel_template/cpu.py benchmark --num-cores 4
         python parallel_template/cpu.py benchmark --num-cores 40
         python parallel_template/cpu.py benchmark --num-cores 100
+
+        # latency/throughput stats and a chrome trace
+        python parallel_template/cpu.py benchmark --num-cores 40 --telemetry stats.json --trace trace.json
+
+        # multi-node, run on every node then merge on any of them
+        python parallel_template/cpu.py benchmark --num-cores 40 --rank 0 --world-size 2 --output-dir shards
+        python parallel_template/cpu.py benchmark --num-cores 40 --rank 1 --world-size 2 --output-dir shards
+        python parallel_template/cpu.py merge --output-dir shards
     """
-    main()
\ No newline at end of file
+    main()
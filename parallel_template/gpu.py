@@ -1,4 +1,12 @@
+import datetime
+import io
+import json
+import math
+import mmap
 import os
+import socket
+import time
+import click
 import torch
 from tqdm.auto import tqdm
 import pickle
@@ -17,9 +25,12 @@ def dist_init():
     if 'WORLD_SIZE' not in os.environ:
         os.environ['WORLD_SIZE'] = '1'
 
-    backend = 'gloo' if os.name == 'nt' else 'nccl'
+    # nccl needs GPUs, fall back to gloo on CPU-only nodes (and windows)
+    use_cuda = torch.cuda.is_available() and os.name != 'nt'
+    backend = 'nccl' if use_cuda else 'gloo'
     torch.distributed.init_process_group(backend=backend, init_method='env://')
-    torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', '0')))
+    if use_cuda:
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', '0')))
 
 
 def get_world_size():
@@ -30,6 +41,15 @@ def get_rank():
     return torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
 
 
+def get_device():
+    r"""
+    device the collectives run on, nccl only works with cuda tensors
+    """
+    if dist.is_initialized() and dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
 def print0(*args, **kwargs):
     if get_rank() == 0:
         print(*args, **kwargs)
@@ -56,85 +76,282 @@ def unflatten_part(keys, shapes, tensor):
     result = {}
     start = 0
     for i, key in enumerate(keys):
-        end = start + shapes[i][0] * int(torch.prod(torch.tensor(shapes[i][1:])))
+        end = start + math.prod(shapes[i])
         result[key] = tensor[start:end].view(shapes[i])
         start = end
     return result
 
 
+def all_gather_padded(tensor):
+    r"""
+    all_gather a 1-D tensor whose length may differ across ranks, using
+    exactly two collectives (sizes, then the padded payload)
+    Returns:
+        list[Tensor]: the un-padded tensor of each rank, on `get_device()`
+    """
+    world_size = get_world_size()
+    device = get_device()
+    tensor = tensor.reshape(-1).to(device)
+
+    # obtain Tensor size of each rank
+    local_size = torch.tensor([tensor.numel()], dtype=torch.long, device=device)
+    size_list = [torch.empty_like(local_size) for _ in range(world_size)]
+    dist.all_gather(size_list, local_size)
+    size_list = [int(size.item()) for size in size_list]
+    max_size = max(size_list)
+
+    # receiving Tensor from all ranks
+    # we pad the tensor because torch all_gather does not support
+    # gathering tensors of different shapes
+    tensor_list = [torch.empty(max_size, dtype=tensor.dtype, device=device) for _ in size_list]
+    if tensor.numel() != max_size:
+        padding = torch.empty(max_size - tensor.numel(), dtype=tensor.dtype, device=device)
+        tensor = torch.cat((tensor, padding), dim=0)
+    dist.all_gather(tensor_list, tensor)
+
+    return [tensor[:size] for size, tensor in zip(size_list, tensor_list)]
+
+
+def pack_dict(dict_of_tensor):
+    r"""
+    pack keys, shapes and values of a dict of same-dtype tensors into one
+    uint8 bucket: [int64 meta length, -1 | pickled (keys, shapes, dtype) | raw values]
+    the -1 tells it apart from a `serialize` bucket (whose second field is >= 0)
+    the meta is padded to 16 bytes so the values can be viewed in place
+    """
+    keys, shapes, tensor = flatten_part(dict_of_tensor)
+    meta = pickle.dumps((keys, shapes, tensor.dtype))
+    meta = meta + b"\0" * (-len(meta) % 16)
+    device = tensor.device
+    header = torch.tensor([len(meta), -1], dtype=torch.long).view(torch.uint8)
+    meta = torch.frombuffer(bytearray(meta), dtype=torch.uint8)
+    payload = tensor.contiguous().view(torch.uint8)
+    return torch.cat((header.to(device), meta.to(device), payload), dim=0)
+
+
+def is_tensor_dict(data):
+    r"""
+    non-empty dict whose values are all tensors of one dtype, what `pack_dict` handles
+    """
+    if not isinstance(data, dict) or not data:
+        return False
+    values = list(data.values())
+    return all(isinstance(value, torch.Tensor) and value.dtype == values[0].dtype for value in values)
+
+
+def is_packed_dict(bucket):
+    return bucket.numel() >= 16 and int(bucket[:16].cpu().view(torch.long)[1].item()) == -1
+
+
+def unpack_dict(bucket):
+    header_size = 16
+    meta_size = int(bucket[:header_size].cpu().view(torch.long)[0].item())
+    meta = bucket[header_size:header_size + meta_size].cpu().numpy().tobytes()
+    keys, shapes, dtype = pickle.loads(meta)
+    tensor = bucket[header_size + meta_size:].view(dtype)
+    return unflatten_part(keys, shapes, tensor)
+
+
+class _TensorPickler(pickle.Pickler):
+    r"""
+    pickles tensors by reference, their raw bytes are sent next to the stream
+    """
+    def __init__(self, file, tensors, **kwargs):
+        super().__init__(file, **kwargs)
+        self.tensors = tensors
+
+    def persistent_id(self, obj):
+        if isinstance(obj, torch.Tensor):
+            self.tensors.append(obj)
+            return ("tensor", len(self.tensors) - 1, obj.dtype, tuple(obj.shape), obj.device.type)
+        return None
+
+
+class _TensorUnpickler(pickle.Unpickler):
+    def __init__(self, file, tensors, **kwargs):
+        super().__init__(file, **kwargs)
+        self.tensors = tensors
+
+    def persistent_load(self, pid):
+        # rebuilt on the host, gathered cuda tensors would otherwise all land on the root's device
+        _, idx, dtype, shape, device_type = pid
+        return self.tensors[idx].view(dtype).reshape(shape)
+
+
+def _bytes_to_tensor(buffer):
+    if len(buffer) == 0:
+        return torch.empty(0, dtype=torch.uint8)
+    return torch.frombuffer(buffer, dtype=torch.uint8)
+
+
+def serialize(data):
+    r"""
+    pickle `data` with protocol 5, numpy arrays (out-of-band buffers) and
+    tensors inside it are not re-serialized but appended as raw bytes
+    bucket: [int64 header | pickle stream | buffers... | tensors...], every
+    segment is padded to 16 bytes so it can be viewed in place on receipt
+    the bucket is built in host memory (pinned when cuda is available), callers
+    move it, or slices of it, to the device themselves
+    """
+    buffers, tensors = [], []
+    stream = io.BytesIO()
+    _TensorPickler(stream, tensors, protocol=5, buffer_callback=buffers.append).dump(data)
+
+    segments = [_bytes_to_tensor(stream.getbuffer())]
+    segments += [_bytes_to_tensor(buffer.raw()) for buffer in buffers]
+    segments += [tensor.detach().contiguous().reshape(-1).view(torch.uint8) for tensor in tensors]
+
+    header = [len(segments), len(buffers)] + [segment.numel() for segment in segments]
+    header += [0] * (len(header) % 2)
+    header = torch.tensor(header, dtype=torch.long).view(torch.uint8)
+    total = header.numel() + sum(segment.numel() + (-segment.numel() % 16) for segment in segments)
+
+    bucket = torch.empty(total, dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+    bucket[:header.numel()].copy_(header)
+    offset = header.numel()
+    for segment in segments:
+        # device tensors are copied straight into the host bucket
+        bucket[offset:offset + segment.numel()].copy_(segment)
+        offset += segment.numel() + (-segment.numel() % 16)
+    return bucket
+
+
+def deserialize(bucket):
+    r"""
+    inverse of `serialize`, slices a single memoryview over the bucket
+    instead of copying it out with `tobytes()`
+    bucket: uint8 tensor or any writable buffer (e.g. a copy-on-write mmap)
+    """
+    if isinstance(bucket, torch.Tensor):
+        bucket = bucket.cpu().numpy()
+    view = memoryview(bucket).cast("B")
+    num_segments, num_buffers = view[:16].cast("q")
+    sizes = view[16:16 + 8 * num_segments].cast("q")
+    offset = 16 + 8 * num_segments
+    offset += -offset % 16
+
+    segments = []
+    for size in sizes:
+        segments.append(view[offset:offset + size])
+        offset += size + (-size % 16)
+
+    stream, buffers, tensors = segments[0], segments[1:1 + num_buffers], segments[1 + num_buffers:]
+    tensors = [_bytes_to_tensor(tensor) for tensor in tensors]
+    return _TensorUnpickler(io.BytesIO(stream), tensors, buffers=buffers).load()
+
+
 def all_gather(data):
     """
     Run all_gather on arbitrary picklable data (not necessarily tensors)
     Args:
         data: any picklable object
     Returns:
-        list[data]: list of data gathered from each rank
+        list[data]: list of data gathered from each rank, except for dicts,
+        which are always merged into one dict (keys of later ranks win)
     """
     world_size = get_world_size()
     if world_size == 1:
-        return [data]
+        return dict(data) if isinstance(data, dict) else [data]
 
     if isinstance(data, dict):
-        keys, shapes, tensor = flatten_part(data)
-        keys_list   = all_gather(keys)
-        shapes_list = all_gather(shapes)
-        tensor_list = all_gather(tensor)
-        keys   = merge_list_of_list(keys_list)
-        shapes = merge_list_of_list(shapes_list)
-        result = unflatten_part(keys, shapes, torch.cat(tensor_list, dim=0))
-        return result
+        # metadata and payload travel in a single bucket, so a dict
+        # costs two collectives instead of three gathers of two each.
+        # other dicts (metrics, strings, ...) are pickled; the bucket says
+        # which one it is, so ranks may even disagree
+        bucket = pack_dict(data) if is_tensor_dict(data) else serialize(data).to(get_device())
+        bucket_list = all_gather_padded(bucket)
+        return merge_list_of_dict([unpack_dict(bucket) if is_packed_dict(bucket) else deserialize(bucket)
+                                   for bucket in bucket_list])
+
+    if isinstance(data, torch.Tensor):
+        # suppose the difference of tensor size exist in first dimension
+        new_shape = [-1] + list(data.size()[1:])
+        return [tensor.reshape(new_shape) for tensor in all_gather_padded(data)]
 
     # serialized to a Tensor
-    origin_size = None
-    if not isinstance(data, torch.Tensor):
-        buffer = pickle.dumps(data)
-        storage = torch.ByteStorage.from_buffer(buffer)
-        tensor = torch.ByteTensor(storage).to("cuda")
-    else:
-        origin_size = data.size()
-        tensor = data.reshape(-1)
+    return [deserialize(bucket) for bucket in all_gather_padded(serialize(data).to(get_device()))]
+    
 
-    tensor_type = tensor.dtype
+def gather_to_root_chunked(data, chunk_size=64 << 20, sink=None, root=0):
+    r"""
+    gather `data` from every rank to `root` without padding, each rank
+    serializes into host memory and sends it in `chunk_size` byte chunks
+    (point-to-point) through one reused device buffer, so only one chunk
+    lives on the device at a time. the root receives into a reused device
+    chunk and copies it to host memory, or to the `sink` file when the
+    results don't fit in RAM
+    Returns:
+        on root, a generator yielding the data of each rank (deserialized
+        lazily, feed it to `merge_results_stream`); None on other ranks
+    """
+    world_size = get_world_size()
+    rank = get_rank()
+    device = get_device()
+    bucket = serialize(data)
 
-    # obtain Tensor size of each rank
-    local_size = torch.LongTensor([tensor.numel()]).to("cuda")
-    size_list = [torch.LongTensor([0]).to("cuda") for _ in range(world_size)]
+    local_size = torch.tensor([bucket.numel()], dtype=torch.long, device=device)
+    size_list = [torch.empty_like(local_size) for _ in range(world_size)]
     dist.all_gather(size_list, local_size)
     size_list = [int(size.item()) for size in size_list]
-    max_size = max(size_list)
 
-    # receiving Tensor from all ranks
-    # we pad the tensor because torch all_gather does not support
-    # gathering tensors of different shapes
-    tensor_list = []
-    for _ in size_list:
-        tensor_list.append(torch.FloatTensor(size=(max_size,)).cuda().to(tensor_type))
-    if local_size != max_size:
-        padding = torch.FloatTensor(size=(max_size - local_size,)).cuda().to(tensor_type)
-        tensor = torch.cat((tensor, padding), dim=0)
-    dist.all_gather(tensor_list, tensor)
+    chunk = torch.empty(max(1, min(chunk_size, max(size_list))), dtype=torch.uint8, device=device)
+    if rank != root:
+        for start in range(0, bucket.numel(), chunk_size):
+            n = min(chunk_size, bucket.numel() - start)
+            if device.type == 'cpu':
+                dist.send(bucket[start:start + n], dst=root)
+                continue
+            chunk[:n].copy_(bucket[start:start + n], non_blocking=True)
+            dist.send(chunk[:n], dst=root)
+        return None
+
+    f = open(sink, "wb") if sink is not None else None
+    # host staging buffer for the sink, reused for every chunk
+    staging = torch.empty(chunk.numel(), dtype=torch.uint8, pin_memory=device.type == 'cuda') if f else None
+    payloads = []
+    for src, size in enumerate(size_list):
+        if src == root:
+            if f is not None:
+                f.write(memoryview(bucket.numpy()))
+            payloads.append(bucket)
+            continue
+        payload = torch.empty(size, dtype=torch.uint8) if f is None else None
+        for start in range(0, size, chunk_size):
+            n = min(chunk_size, size - start)
+            part = chunk[:n]
+            dist.recv(part, src=src)
+            if f is not None:
+                staging[:n].copy_(part)
+                f.write(memoryview(staging[:n].numpy()))
+            else:
+                payload[start:start + n].copy_(part)
+        payloads.append(payload)
+    del chunk, staging
+
+    if f is None:
+        return (deserialize(payload) for payload in payloads)
+
+    f.close()
+    with open(sink + ".index.json", "w") as f:
+        json.dump({"sizes": size_list}, f)
+    return iter_gathered_file(sink)
+
+
+def iter_gathered_file(sink):
+    r"""
+    lazily read back the payloads written by `gather_to_root_chunked(sink=...)`
+    """
+    with open(sink + ".index.json", "r") as f:
+        size_list = json.load(f)["sizes"]
+    with open(sink, "rb") as f:
+        # copy-on-write keeps the buffers writable for torch.frombuffer
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(buffer)
+    offset = 0
+    for size in size_list:
+        yield deserialize(view[offset:offset + size])
+        offset += size
 
-    data_list = []
-    for size, tensor in zip(size_list, tensor_list):
-        if origin_size is None:
-            buffer = tensor.cpu().numpy().tobytes()[:size]
-            data_list.append(pickle.loads(buffer))
-        else:
-            buffer = tensor[:size]
-            data_list.append(buffer)
-
-    if origin_size is not None:
-        new_shape = [-1] + list(origin_size[1:])
-        resized_list = []
-        for data in data_list:
-            # suppose the difference of tensor size exist in first dimension
-            data = data.reshape(new_shape)
-            resized_list.append(data)
-
-        return resized_list
-    else:
-        return data_list
-    
 
 def merge_list_of_list(list_of_list):
     ret = []
@@ -159,6 +376,277 @@ def merge_results(results):
         raise NotImplementedError
 
 
+def merge_results_stream(results):
+    r"""
+    streaming counterpart of `merge_results`, consumes the results of
+    each rank one at a time (e.g. from `gather_to_root_chunked`)
+    """
+    ret = None
+    for result in results:
+        if ret is None:
+            if isinstance(result, dict):
+                ret = {}
+            elif isinstance(result, list):
+                ret = []
+            else:
+                raise NotImplementedError
+        if isinstance(ret, dict):
+            ret.update(result)
+        else:
+            ret.extend(result)
+    return ret
+
+
+def get_store(timeout=300):
+    r"""
+    a key-value store for coordination next to the process group, hosted
+    by rank 0 on MASTER_PORT + 1
+    """
+    return dist.TCPStore(
+        os.environ.get('MASTER_ADDR', 'localhost'),
+        int(os.environ.get('MASTER_PORT', '29500')) + 1,
+        get_world_size(),
+        is_master=get_rank() == 0,
+        timeout=datetime.timedelta(seconds=timeout),
+    )
+
+
+class WorkQueue:
+    r"""
+    dynamic work-stealing dispatcher on top of a `torch.distributed` store
+    (TCPStore / FileStore). instead of a static `all_ids[rank::world_size]`
+    split, ranks pull the next batch of tasks when they are free, and once
+    the queue is drained they re-dispatch batches claimed by ranks whose
+    heartbeat is older than `heartbeat_timeout` (dead ranks).
+    `heartbeat_timeout` must be longer than the slowest batch, otherwise a
+    slow batch is executed twice (harmless, the result is the same).
+
+    results go through the store, so keep them small (or return file paths)
+    `run` ends with a barrier over the live ranks, so rank 0 (which hosts a
+    TCPStore) does not take the store down while other ranks still use it
+    """
+    def __init__(self, store, num_tasks, batch_size=1, heartbeat_timeout=60.0, poll_interval=0.5, prefix="work_queue"):
+        self.store = dist.PrefixStore(prefix, store)
+        self.num_tasks = num_tasks
+        self.batch_size = batch_size
+        self.num_batches = math.ceil(num_tasks / batch_size)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.poll_interval = poll_interval
+        self.rank = str(get_rank()).encode()
+        self.started = time.time()
+        self.pending = None  # batches not known to be done, see `_next_stale`
+        self.heartbeat()
+
+    def heartbeat(self):
+        self.store.set(f"heartbeat/{self.rank.decode()}", str(time.time()))
+
+    def _last_seen(self, rank):
+        key = f"heartbeat/{rank.decode()}"
+        if not self.store.check([key]):
+            return 0.0
+        return float(self.store.get(key))
+
+    def _is_done(self, idx):
+        return self.store.check([f"done/{idx}"])
+
+    def _claim(self, idx, owner=b""):
+        # compare_set only sets the claim if it still holds `owner` (or is
+        # missing when `owner` is empty), so exactly one rank wins a batch
+        return self.store.compare_set(f"claim/{idx}", owner, self.rank) == self.rank
+
+    def _next_new(self):
+        while True:
+            idx = self.store.add("next", 1) - 1
+            if idx >= self.num_batches:
+                return None
+            if self._claim(idx):
+                return idx
+
+    def _next_stale(self):
+        # a batch never becomes undone, so every batch is checked once and later
+        # polls only look at the few that were still claimed but not done
+        if self.pending is None:
+            self.pending = range(self.num_batches)
+        self.pending = [idx for idx in self.pending if not self._is_done(idx)]
+        now = time.time()
+        last_seen = {}
+        for idx in self.pending:
+            owner = self.store.compare_set(f"claim/{idx}", b"", self.rank)
+            if owner == self.rank:
+                return idx
+            if owner not in last_seen:
+                last_seen[owner] = self._last_seen(owner)
+            if now - last_seen[owner] > self.heartbeat_timeout:
+                if self._claim(idx, owner):
+                    print(f"[rank {self.rank.decode()}] re-dispatching batch {idx} of rank {owner.decode()}")
+                    return idx
+        return None
+
+    def num_done(self):
+        return self.store.add("num_done", 0)
+
+    def batches(self):
+        r"""
+        yield (batch index, task slice) until every batch is done
+        """
+        while True:
+            self.heartbeat()
+            idx = self._next_new()
+            if idx is None:
+                if self.num_done() >= self.num_batches:
+                    return
+                idx = self._next_stale()
+            if idx is None:
+                time.sleep(self.poll_interval)
+                continue
+            yield idx, slice(idx * self.batch_size, min((idx + 1) * self.batch_size, self.num_tasks))
+
+    def finish(self, idx, result):
+        self.store.set(f"result/{idx}", pickle.dumps(result))
+        # count each batch once, even if it was executed twice
+        if self.store.compare_set(f"done/{idx}", b"", self.rank) == self.rank:
+            self.store.add("num_done", 1)
+        self.heartbeat()
+
+    def run(self, fn, tasks):
+        r"""
+        call `fn(tasks[batch])` on every batch this rank gets
+        """
+        for idx, batch in self.batches():
+            self.finish(idx, fn(tasks[batch]))
+        self.barrier()
+
+    def barrier(self):
+        r"""
+        wait until every other rank has left `run` or is dead (no heartbeat for
+        `heartbeat_timeout`), a rank that has not started yet counts from our start.
+        rank 0 then also waits for the others to get past the barrier, they may
+        still be polling the store when the last rank arrives
+        """
+        self._wait_all("exited")
+        if get_rank() == 0:
+            self._wait_all("left")
+        else:
+            self.store.set(f"left/{self.rank.decode()}", "1")
+
+    def _wait_all(self, key):
+        self.store.set(f"{key}/{self.rank.decode()}", "1")
+        waiting = [str(rank).encode() for rank in range(get_world_size())]
+        while True:
+            now = time.time()
+            waiting = [rank for rank in waiting if not self.store.check([f"{key}/{rank.decode()}"])
+                       and now - max(self._last_seen(rank), self.started) <= self.heartbeat_timeout]
+            if not waiting:
+                return
+            self.heartbeat()
+            time.sleep(self.poll_interval)
+
+    def results(self):
+        r"""
+        per-batch results in task order, call after `run` (usually on rank 0)
+        """
+        return [pickle.loads(self.store.get(f"result/{idx}")) for idx in range(self.num_batches)]
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def spawn_local(fn, world_size, *args):
+    r"""
+    run `fn(*args)` in `world_size` local CPU processes joined by a gloo
+    process group, for testing distributed code without GPUs
+    """
+    port = get_free_port()
+    torch.multiprocessing.spawn(_spawn_entry, args=(world_size, port, fn, args), nprocs=world_size, join=True)
+
+
+def _spawn_entry(rank, world_size, port, fn, args):
+    os.environ.update({
+        'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port),
+        'RANK': str(rank), 'LOCAL_RANK': str(rank), 'WORLD_SIZE': str(world_size),
+    })
+    dist.init_process_group(backend='gloo', init_method='env://')
+    fn(*args)
+
+
+def _test_dispatch(num_tasks, batch_size, dead_rank):
+    store = get_store(timeout=60)
+    queue = WorkQueue(store, num_tasks, batch_size=batch_size, heartbeat_timeout=2.0, poll_interval=0.1)
+
+    def worker(sub_ids):
+        if get_rank() == dead_rank:
+            # die holding a claimed batch, the others have to pick it up
+            os._exit(0)
+        time.sleep(0.01 * (sub_ids[0] % 7))
+        return {i: i * i for i in sub_ids}
+
+    queue.run(worker, list(range(num_tasks)))
+
+    if get_rank() == 0:
+        ret = merge_results(queue.results())
+        assert ret == {i: i * i for i in range(num_tasks)}, "missing or wrong results"
+        print(f"dispatched {num_tasks} tasks over {get_world_size()} ranks (dead rank: {dead_rank}): OK")
+
+
+def make_payload(kind, num_bytes):
+    r"""
+    payloads for `benchmark`, roughly `num_bytes` large
+    """
+    num_floats = max(num_bytes // 4, 1)
+    if kind == "tensor":
+        return torch.rand(num_floats).to(get_device())
+    if kind == "dict":
+        num_keys = 16
+        return {
+            f"rank-{get_rank()}-{i}": torch.rand(max(num_floats // num_keys, 1)).to(get_device())
+            for i in range(num_keys)
+        }
+    if kind == "pickle":
+        return [f"rank-{get_rank()}-item-{i:08d}" for i in range(max(num_bytes // 64, 1))]
+    raise NotImplementedError(kind)
+
+
+def _time(fn, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        if get_device().type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if get_device().type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def _benchmark(kinds, sizes, repeat, warmup, report_path):
+    report = {}
+    for kind in kinds:
+        for size in sizes:
+            payload = make_payload(kind, size)
+            latency = _time(lambda: all_gather(payload), repeat, warmup)
+            report[f"all_gather/{kind}/{size}"] = {
+                "latency": latency,
+                # bytes received by each rank per second
+                "bandwidth": size * get_world_size() / latency,
+            }
+
+    for size in sizes:
+        payload = make_payload("dict", size)
+        keys, shapes, tensor = flatten_part(payload)
+        report[f"flatten_part/{size}"] = {"latency": _time(lambda: flatten_part(payload), repeat, warmup)}
+        report[f"unflatten_part/{size}"] = {"latency": _time(lambda: unflatten_part(keys, shapes, tensor), repeat, warmup)}
+
+    if get_rank() == 0:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
 def main_worker(sub_ids):
     for _ in tqdm(range(len(sub_ids)), disable=get_rank() > 0):
         pass
@@ -174,19 +662,109 @@ def main():
     # all_ids = list(range(100))
     # sub_ids = all_ids[get_rank()::get_world_size()]
     # ret = main_worker(sub_ids)
-    # ret = all_gather(ret)
-    # print0(merge_results(ret))
+    # ret = all_gather(ret)  # dicts come back merged, lists as one list per rank
+    # print0(ret)
+
+    # or let ranks pull batches on demand, fast ranks don't wait for slow ones
+    # queue = WorkQueue(get_store(), len(all_ids), batch_size=8)
+    # queue.run(main_worker, all_ids)
+    # if get_rank() == 0:
+    #     print(merge_results(queue.results()))
+
+    # for results larger than device memory, gather to rank 0 in chunks
+    # ret = gather_to_root_chunked(ret, sink="results.bin")
+    # if get_rank() == 0:
+    #     print(merge_results_stream(ret))
     
     torch.random.manual_seed(0)
     torch.cuda.manual_seed_all(0)
+    device = get_device()
     dict_of_tensor = {
-        f"gpu-{get_rank()}-0": torch.rand(1 + get_rank(), 2 + get_rank()).cuda(),
-        f"gpu-{get_rank()}-1": torch.rand(2 + get_rank(), 1 + get_rank()).cuda(),
+        f"gpu-{get_rank()}-0": torch.rand(1 + get_rank(), 2 + get_rank()).to(device),
+        f"gpu-{get_rank()}-1": torch.rand(2 + get_rank(), 1 + get_rank()).to(device),
     }
     ret = all_gather(dict_of_tensor)
     for k, v in dict_of_tensor.items():
         assert k in ret and torch.allclose(v, ret[k])
     
 
+@click.group(invoke_without_command=True)
+@click.pass_context
+def cli(ctx):
+    r"""
+    without a sub-command, run `main` (e.g. under torchrun)
+    """
+    if ctx.invoked_subcommand is None:
+        main()
+
+
+@cli.command()
+@click.option("--world-size", type=int, default=4)
+@click.option("--num-tasks", type=int, default=200)
+@click.option("--batch-size", type=int, default=3)
+@click.option("--dead-rank", type=int, default=-1, help="rank that dies mid-run, -1 for none")
+def test_dispatch(world_size, num_tasks, batch_size, dead_rank):
+    r"""
+    check `WorkQueue` with local gloo processes
+    """
+    assert dead_rank != 0, "rank 0 hosts the store"
+    spawn_local(_test_dispatch, world_size, num_tasks, batch_size, dead_rank)
+
+
+@cli.command()
+@click.option("--world-size", type=int, default=4)
+@click.option("--kinds", type=str, default="tensor,dict,pickle")
+@click.option("--sizes", type=str, default="1024,1048576,16777216", help="payload sizes in bytes")
+@click.option("--repeat", type=int, default=20)
+@click.option("--warmup", type=int, default=3)
+@click.option("--baseline", type=str, default="gather_baseline.json")
+@click.option("--save-baseline", is_flag=True, help="overwrite the baseline with this run")
+@click.option("--tolerance", type=float, default=0.2, help="allowed slowdown vs. the baseline")
+def benchmark(world_size, kinds, sizes, repeat, warmup, baseline, save_baseline, tolerance):
+    r"""
+    time `all_gather`, `flatten_part` and `unflatten_part` over local gloo
+    processes, and fail if any entry is slower than the saved baseline
+    """
+    kinds = kinds.split(",")
+    sizes = [int(size) for size in sizes.split(",")]
+    report_path = f"gather_report_{os.getpid()}.json"
+    spawn_local(_benchmark, world_size, kinds, sizes, repeat, warmup, report_path)
+    with open(report_path, "r") as f:
+        report = json.load(f)
+    os.remove(report_path)
+
+    reference = {}
+    if os.path.exists(baseline) and not save_baseline:
+        with open(baseline, "r") as f:
+            reference = json.load(f)
+
+    regressions = []
+    print(f"{'name':<36}{'latency (ms)':>14}{'bandwidth (MB/s)':>18}{'vs. baseline':>14}")
+    for name, entry in report.items():
+        bandwidth = f"{entry['bandwidth'] / 1e6:.1f}" if "bandwidth" in entry else "-"
+        ratio = "-"
+        if name in reference:
+            ratio = entry["latency"] / reference[name]["latency"]
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+            ratio = f"{ratio:.2f}x"
+        print(f"{name:<36}{entry['latency'] * 1000:>14.3f}{bandwidth:>18}{ratio:>14}")
+
+    if save_baseline:
+        with open(baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {baseline}")
+    if regressions:
+        raise click.ClickException(f"Slower than {baseline} by more than {tolerance:.0%}: {', '.join(regressions)}")
+
+
 if __name__ == "__main__":
-    main()
+    r"""
+    Command:
+        torchrun --nproc_per_node 8 parallel_template/gpu.py
+        python parallel_template/gpu.py test-dispatch --world-size 4
+        python parallel_template/gpu.py test-dispatch --world-size 4 --dead-rank 3
+        python parallel_template/gpu.py benchmark --world-size 4 --save-baseline
+        python parallel_template/gpu.py benchmark --world-size 4
+    """
+    cli()
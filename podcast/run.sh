@@ -3,6 +3,5 @@ URLS=(
     https://www.xiaoyuzhoufm.com/episode/66f5701b2adfe48b83b0a9fa
 )
 
-for url in "${URLS[@]}"; do
-    python xiaoyuzhou.py download-audio --url $url --output_path "downloaded_audio" --cookies_file "cookies.txt"
-done
\ No newline at end of file
+# one process for all episodes: pooled connections, concurrent resumable downloads
+python xiaoyuzhou.py batch "${URLS[@]}" --output_path "downloaded_audio" --cookies_file "cookies.txt" --workers 8 --transcribe
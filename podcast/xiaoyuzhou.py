@@ -1,8 +1,18 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 import re
 import os
-from urllib.parse import urljoin
+import functools
+import hashlib
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin, urlparse
 
 import click
 import json
@@ -30,50 +40,148 @@ def load_cookies_from_file(file_path):
         return None
 
 
-@cli.command()
-@click.option("--url", required=True, help="URL of the webpage containing audio links")
-@click.option("--output_path", default="downloaded_audio", help="Output directory for downloaded audio files")
-@click.option("--cookies_file", help="Path to JSON file containing cookies")
-def download_audio(url, output_path="downloaded_audio", cookies_file=None):
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
 
-    os.makedirs(output_path, exist_ok=True)
+# Define common audio file extensions
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.ogg', '.m4a', '.aac')
 
-    # Load cookies from file if provided
-    cookies = load_cookies_from_file(cookies_file) if cookies_file else None
+CHUNK_SIZE = 1 << 20
+# small reads: an interrupted read loses at most this much
+READ_SIZE = 64 << 10
 
-    # Set up headers
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
 
-    # Send a GET request to the target webpage
-    try:
-        response = requests.get(url, cookies=cookies, headers=headers)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Error accessing the webpage: {e}")
-        return
-
-    # Send a GET request to the target webpage
-    # response = requests.get(url, cookies=cookies)
+def make_session(pool_size=16, cookies=None):
+    r"""
+    one session for all requests: keep-alive connections are pooled and reused,
+    connection errors and 5xx are retried with backoff
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), allowed_methods=("GET",))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(HEADERS)
+    if cookies:
+        session.cookies.update(cookies)
+    return session
+
+
+def find_audio_links(session, url):
+    response = session.get(url, timeout=30)
+    response.raise_for_status()
     soup = BeautifulSoup(response.content, 'html.parser')
 
-    # Define common audio file extensions
-    audio_extensions = ('.mp3', '.wav', '.ogg', '.m4a', '.aac')
-
     # Find all links
     links = soup.find_all('a', href=True)
     audio_links = set()  # Use a set to avoid duplicates
     for link in links:
         href = link['href']
-        if href.lower().endswith(audio_extensions):
+        if href.lower().endswith(AUDIO_EXTENSIONS):
             full_url = urljoin(url, href)
             audio_links.add(full_url)
 
     # If no explicit audio links found, search the entire HTML
     if not audio_links:
-        pattern = r'https?://[^\s<>"\']+(?:{})'.format('|'.join(audio_extensions))
+        pattern = r'https?://[^\s<>"\']+(?:{})'.format('|'.join(AUDIO_EXTENSIONS))
         audio_links = set(re.findall(pattern, str(soup), re.IGNORECASE))
+    return audio_links
+
+
+def audio_file_name(audio_url):
+    r"""
+    sha256(url) prefix + the url basename: depends on the url only, so a file keeps
+    its name (and `.part`) across runs, and urls sharing a basename
+    (e.g. `.../a/audio.m4a` and `.../b/audio.m4a`) never write the same file
+    """
+    file_name = os.path.basename(urlparse(audio_url).path) or "audio"
+    return f"{hashlib.sha256(audio_url.encode('utf-8')).hexdigest()[:12]}-{file_name}"
+
+
+def content_range(response):
+    r"""
+    `bytes start-end/size` or `bytes */size` -> (start or None, size or None)
+    """
+    match = re.match(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)", response.headers.get("Content-Range", ""))
+    if match is None:
+        return None, None
+    start, size = match.groups()
+    return (int(start) if start else None), (int(size) if size != "*" else None)
+
+
+def download_file(session, audio_url, output_path, chunk_size=CHUNK_SIZE, file_name=None):
+    r"""
+    download into `<file>.part`, resumed with an HTTP Range request if it exists,
+    renamed to `<file>` only once complete
+    reads in READ_SIZE pieces (what was received before an interruption is kept),
+    writes through a `chunk_size` buffer
+    Returns:
+        (file path, bytes downloaded now), 0 bytes if it was already there
+    """
+    file_name = file_name or audio_file_name(audio_url)
+    file_path = os.path.join(output_path, file_name)
+    if os.path.exists(file_path):
+        return file_path, 0
+
+    part_path = file_path + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    downloaded = 0
+    with session.get(audio_url, headers=headers, stream=True, timeout=60) as response:
+        start, size = content_range(response)
+        if response.status_code == 416:
+            # the .part file has every byte only if it matches the remote size
+            if size != offset:
+                os.remove(part_path)
+                return download_file(session, audio_url, output_path, chunk_size, file_name)
+        else:
+            response.raise_for_status()
+            if response.status_code == 206 and start != offset:
+                # not the range we asked for, appending would corrupt the file
+                os.remove(part_path)
+                return download_file(session, audio_url, output_path, chunk_size, file_name)
+            # 206 continues the partial file, 200 means the server ignored the Range
+            mode = "ab" if response.status_code == 206 else "wb"
+            with open(part_path, mode, buffering=chunk_size) as f:
+                for chunk in response.iter_content(chunk_size=READ_SIZE):
+                    f.write(chunk)
+                    downloaded += len(chunk)
+    os.replace(part_path, file_path)
+    return file_path, downloaded
+
+
+def transcribe_whisper(file_path, model=None):
+    # transcribe
+    import whisper
+    model = model or whisper.load_model("large")
+    result = model.transcribe(file_path)
+    print(result["text"])
+
+    # write to file, replace audio extension with .txt
+    output_path = os.path.splitext(file_path)[0] + ".txt"
+    with open(output_path, "w") as f:
+        f.write(result["text"])
+
+
+@cli.command()
+@click.option("--url", required=True, help="URL of the webpage containing audio links")
+@click.option("--output_path", default="downloaded_audio", help="Output directory for downloaded audio files")
+@click.option("--cookies_file", help="Path to JSON file containing cookies")
+def download_audio(url, output_path="downloaded_audio", cookies_file=None):
+
+    os.makedirs(output_path, exist_ok=True)
+
+    # Load cookies from file if provided
+    cookies = load_cookies_from_file(cookies_file) if cookies_file else None
+    session = make_session(cookies=cookies)
+
+    # Send a GET request to the target webpage
+    try:
+        audio_links = find_audio_links(session, url)
+    except requests.exceptions.RequestException as e:
+        print(f"Error accessing the webpage: {e}")
+        return
 
     if not audio_links:
         print("No audio file links found")
@@ -81,42 +189,178 @@ def download_audio(url, output_path="downloaded_audio", cookies_file=None):
 
     output_list = []
     for audio_url in audio_links:
-        # Extract filename from URL
-        file_name = os.path.basename(audio_url)
-        file_path = os.path.join(output_path, file_name)
-
-        # Check if file already exists
-        if os.path.exists(file_path):
+        print(f"Downloading: {audio_url}")
+        try:
+            file_path, downloaded = download_file(session, audio_url, output_path)
+        except requests.exceptions.RequestException as e:
+            print(f"Download failed: {audio_url}. Error: {e}")
+            continue
+        if not downloaded:
             print(f"File already exists, skipping: {file_path}")
             continue
+        print(f"Download complete at {file_path}")
+        output_list.append(file_path)
+        transcribe_whisper(file_path)
 
-        print(f"Downloading: {file_name}")
-        
-        # Download audio file
-        try:
-            audio_response = requests.get(audio_url, stream=True, cookies=cookies)
-            audio_response.raise_for_status()
-            
-            with open(file_path, 'wb') as f:
-                for chunk in audio_response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            print(f"Download complete at {file_path}")
-            output_list.append(file_path)
-        except requests.exceptions.RequestException as e:
-            print(f"Download failed: {file_name}. Error: {e}")
+    return output_list
+
+
+def download_batch(urls, output_path="downloaded_audio", cookies=None, workers=8, chunk_size=CHUNK_SIZE):
+    r"""
+    episode pages -> audio files, pages and files are fetched `workers` at a time over one session
+    Returns:
+        {audio url: file path}, failed downloads are reported and left as `.part`
+    """
+    os.makedirs(output_path, exist_ok=True)
+    session = make_session(pool_size=workers, cookies=cookies)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        audio_links = set()
+        pages = {pool.submit(find_audio_links, session, url): url for url in urls}
+        for future in as_completed(pages):
+            try:
+                links = future.result()
+            except requests.exceptions.RequestException as e:
+                print(f"Error accessing the webpage {pages[future]}: {e}")
+                continue
+            if not links:
+                print(f"No audio file links found in {pages[future]}")
+            audio_links |= links
+
+        results, total = {}, 0
+        downloads = {pool.submit(download_file, session, audio_url, output_path, chunk_size): audio_url
+                     for audio_url in sorted(audio_links)}
+        for future in as_completed(downloads):
+            audio_url = downloads[future]
+            try:
+                file_path, downloaded = future.result()
+            except requests.exceptions.RequestException as e:
+                print(f"Download failed: {audio_url}. Error: {e}")
+                continue
+            total += downloaded
+            results[audio_url] = file_path
+            print(f"{'Download complete' if downloaded else 'Already downloaded'}: {file_path}")
+    elapsed = time.perf_counter() - start
+    print(f"{len(results)}/{len(audio_links)} files, {total / 1e6:.1f} MB in {elapsed:.1f}s "
+          f"({total / 1e6 / max(elapsed, 1e-9):.1f} MB/s)")
+    return results
 
-        # transcribe
+
+@cli.command()
+@click.argument("urls", nargs=-1)
+@click.option("--urls_file", help="File with one episode URL per line")
+@click.option("--output_path", default="downloaded_audio", help="Output directory for downloaded audio files")
+@click.option("--cookies_file", help="Path to JSON file containing cookies")
+@click.option("--workers", type=int, default=8)
+@click.option("--transcribe", "do_transcribe", is_flag=True, help="Transcribe the new files with whisper")
+def batch(urls, urls_file, output_path, cookies_file, workers, do_transcribe):
+    urls = list(urls)
+    if urls_file:
+        with open(urls_file, "r") as f:
+            urls += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    cookies = load_cookies_from_file(cookies_file) if cookies_file else None
+    results = download_batch(urls, output_path, cookies=cookies, workers=workers)
+
+    if do_transcribe:
         import whisper
         model = whisper.load_model("large")
-        result = model.transcribe(file_path)
-        print(result["text"])
+        for file_path in sorted(results.values()):
+            if not os.path.exists(os.path.splitext(file_path)[0] + ".txt"):
+                transcribe_whisper(file_path, model)
 
-        # write to file, replace audio extension with .txt
-        output_path = os.path.splitext(file_path)[0] + ".txt"
-        with open(output_path, "w") as f:
-            f.write(result["text"])
 
-    return output_list
+class RangeHandler(SimpleHTTPRequestHandler):
+    r"""
+    static files with Range support, the first response of every file is cut
+    after `drop_after` bytes to simulate an interrupted download.
+    `stats` counts the partial (206) responses and the audio bytes sent
+    """
+    drop_after = None
+    dropped = set()
+    stats = Counter()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path) or not path.endswith(AUDIO_EXTENSIONS):
+            return super().do_GET()
+        size = os.path.getsize(path)
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        start = int(match.group(1)) if match else 0
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return
+        with self.lock:
+            self.stats[206 if match else 200] += 1
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.send_header("Content-Length", str(size - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read()
+        if self.drop_after is not None and path not in self.dropped:
+            self.dropped.add(path)
+            data = data[:self.drop_after]
+            self.close_connection = True
+        with self.lock:
+            self.stats["bytes"] += len(data)
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@cli.command()
+@click.option("--num-episodes", type=int, default=8)
+@click.option("--size-mb", type=int, default=8)
+@click.option("--workers", type=int, default=8)
+def selftest(num_episodes, size_mb, workers):
+    r"""
+    serve fake episodes from a local HTTP server, interrupt every download once,
+    resume them and check the bytes. every episode's audio is named `audio.m4a`
+    (in its own directory), so the file names have to be told apart
+    """
+    with tempfile.TemporaryDirectory() as root:
+        site, output_path = os.path.join(root, "site"), os.path.join(root, "downloaded_audio")
+        total_size = num_episodes * (size_mb << 20)
+        for i in range(num_episodes):
+            os.makedirs(os.path.join(site, f"ep{i}"))
+            with open(os.path.join(site, f"ep{i}", "audio.m4a"), "wb") as f:
+                f.write(os.urandom(size_mb << 20))
+            with open(os.path.join(site, f"episode{i}.html"), "w") as f:
+                f.write(f'<html><body><a href="ep{i}/audio.m4a">audio</a></body></html>')
+
+        handler = functools.partial(RangeHandler, directory=site)
+        RangeHandler.drop_after = (size_mb << 20) // 3
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        urls = [f"http://127.0.0.1:{server.server_address[1]}/episode{i}.html" for i in range(num_episodes)]
+        try:
+            # first pass is cut off, leaves .part files
+            download_batch(urls, output_path, workers=workers)
+            parts = [f for f in os.listdir(output_path) if f.endswith('.part')]
+            kept = sum(os.path.getsize(os.path.join(output_path, f)) for f in parts)
+            print(f"partial files: {len(parts)}, {kept / 1e6:.1f} MB kept")
+            RangeHandler.stats.clear()
+            results = download_batch(urls, output_path, workers=workers)
+        finally:
+            server.shutdown()
+
+        for audio_url, file_path in results.items():
+            with open(file_path, "rb") as f, open(os.path.join(site, urlparse(audio_url).path.lstrip("/")), "rb") as g:
+                assert f.read() == g.read(), f"{file_path} differs"
+        assert len(results) == num_episodes and not any(f.endswith(".part") for f in os.listdir(output_path))
+        assert all(os.path.basename(file_path) == audio_file_name(audio_url) for audio_url, file_path in results.items())
+        # the second pass must have resumed (206) and sent only the missing bytes
+        stats = RangeHandler.stats
+        assert stats[206] == num_episodes and stats[200] == 0, f"not resumed: {dict(stats)}"
+        assert stats["bytes"] == total_size - kept, f"sent {stats['bytes']} bytes, {total_size - kept} were missing"
+        print(f"all files resumed and complete, second pass sent {stats['bytes'] / 1e6:.1f} of {total_size / 1e6:.1f} MB")
 
 
 @cli.command()
@@ -177,6 +421,8 @@ if __name__ == "__main__":
     r"""
     demo usage:
         python xiaoyuzhou.py download-audio --url "https://www.xiaoyuzhoufm.com/episode/66d7b5fa4a0f950f845a2a2e" --output_path "downloaded_audio"
+        python xiaoyuzhou.py batch URL1 URL2 ... --output_path "downloaded_audio" --workers 8 --transcribe
+        python xiaoyuzhou.py selftest
         python xiaoyuzhou.py transcribe --audio_path "downloaded_audio/ltwjjENqEP3IRbUOoYOD2s01Yi2x.m4a"
     """
     cli()
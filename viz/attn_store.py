@@ -0,0 +1,305 @@
+r"""
+Dump attention maps from many layers / heads / steps to disk, look at them later.
+
+    store = AttentionStore("attn_dump", size=256)
+    for step, batch in enumerate(loader):
+        ...
+        store.add_batch(attn, step=step)   # attn: (layers, heads, n, n), on any device
+    store.close()
+
+maps are pooled (on the device) to at most `size` x `size` and appended to a
+memory-mapped `maps.npy` of shape (num_maps, size, size), `index.jsonl` has one
+line per map with its position, metadata and original shape. Reading never
+loads more than the maps that are displayed.
+
+pip install click numpy matplotlib
+"""
+
+import io
+import json
+import math
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import click
+import numpy as np
+
+from mat_viz import mat_to_png, pool_matrix, render_batch
+
+
+HEADER_LEN = 256
+
+
+def shrink(mat, size, mode="max"):
+    r"""
+    pool to at most `size` x `size`, torch tensors are pooled on their device
+    so only the small map is copied to the host
+    """
+    if hasattr(mat, "detach"):
+        import torch.nn.functional as F
+        mat = mat.detach().float()
+        k = math.ceil(max(mat.shape) / size)
+        if k > 1:
+            pool_fn = F.max_pool2d if mode == "max" else F.avg_pool2d
+            mat = pool_fn(mat[None, None], k, ceil_mode=True)[0, 0]
+        mat = mat.cpu().numpy()
+    return pool_matrix(mat, max_size=size, mode=mode)
+
+
+class AttentionStore:
+    def __init__(self, path, size=256, dtype="float16", pool="max"):
+        self.path = path
+        self.data_path = os.path.join(path, "maps.npy")
+        self.index_path = os.path.join(path, "index.jsonl")
+        self.pool = pool
+        os.makedirs(path, exist_ok=True)
+
+        if os.path.exists(self.data_path):
+            with open(self.data_path, "rb") as f:
+                np.lib.format.read_magic(f)
+                shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+            size = shape[1]
+        self.size = size
+        self.dtype = np.dtype(dtype)
+        self.map_bytes = size * size * self.dtype.itemsize
+
+        self.index = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = [json.loads(line) for line in f if line.strip()]
+        if not os.path.exists(self.data_path):
+            with open(self.data_path, "wb") as f:
+                f.write(self.header(0))
+        # the data file is the source of truth after a crash: drop index lines without data
+        count = (os.path.getsize(self.data_path) - HEADER_LEN) // self.map_bytes
+        self.index = self.index[:count]
+        self.data_file = None
+        self.index_file = None
+        self._memmap = None
+
+    def header(self, count):
+        r"""
+        .npy (version 1.0) header padded to HEADER_LEN bytes, so it can be rewritten in place as the count grows
+        """
+        header = repr({"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False,
+                       "shape": (count, self.size, self.size)})
+        header = header.ljust(HEADER_LEN - 10 - 1) + "\n"
+        return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, mat, **meta):
+        r"""
+        append one (h, w) matrix, `meta` (layer, head, step, ...) goes to the index
+        """
+        if self.data_file is None:
+            self.data_file = open(self.data_path, "r+b")
+            self.data_file.seek(HEADER_LEN + len(self.index) * self.map_bytes)
+            self.index_file = open(self.index_path, "w")
+            for entry in self.index:
+                self.index_file.write(json.dumps(entry) + "\n")
+        h, w = mat.shape[-2:]
+        small = shrink(mat, self.size, mode=self.pool)
+        out = np.full((self.size, self.size), np.nan, dtype=self.dtype)
+        out[:small.shape[0], :small.shape[1]] = small
+        self.data_file.write(out.tobytes())
+        entry = {"id": len(self.index), "shape": [int(h), int(w)], "stored": list(small.shape), **meta}
+        self.index.append(entry)
+        self.index_file.write(json.dumps(entry) + "\n")
+        self._memmap = None
+        return entry["id"]
+
+    def add_batch(self, mats, names=("layer", "head"), **meta):
+        r"""
+        append every matrix of `mats` (..., h, w), the leading indices are recorded as `names`
+        """
+        lead = tuple(mats.shape[:-2])
+        names = (tuple(f"dim{i}" for i in range(len(lead))) + tuple(names))[-len(lead):] if lead else ()
+        for index in np.ndindex(*lead):
+            self.add(mats[index], **dict(zip(names, index)), **meta)
+
+    def flush(self):
+        if self.data_file is not None:
+            self.data_file.flush()
+            self.index_file.flush()
+            self.data_file.seek(0)
+            self.data_file.write(self.header(len(self.index)))
+            self.data_file.seek(0, os.SEEK_END)
+            self.data_file.flush()
+
+    def close(self):
+        self.flush()
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+            self.data_file = self.index_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def maps(self):
+        if self._memmap is None:
+            self.flush()
+            self._memmap = np.memmap(self.data_path, dtype=self.dtype, mode="r", offset=HEADER_LEN,
+                                     shape=(len(self.index), self.size, self.size))
+        return self._memmap
+
+    def __getitem__(self, i):
+        h, w = self.index[i]["stored"]
+        return np.asarray(self.maps[i, :h, :w], dtype=np.float32)
+
+    def select(self, **where):
+        r"""
+        ids of the maps whose metadata matches, e.g. select(layer=3, step=100)
+        """
+        return [entry["id"] for entry in self.index if all(entry.get(k) == v for k, v in where.items())]
+
+
+def caption(entry):
+    return " ".join(f"{k}={v}" for k, v in entry.items() if k not in ("id", "stored"))
+
+
+def render_page(store, ids, page, num_pages, src, href):
+    cells = "".join(
+        f'<figure><img loading="lazy" src="{src(i)}"><figcaption>#{i} {caption(store.index[i])}</figcaption></figure>'
+        for i in ids)
+    nav = " ".join(f'<a href="{href(p)}">{p}</a>' if p != page else f"<b>{p}</b>" for p in range(num_pages))
+    return ("<!doctype html><html><head><meta charset='utf-8'><style>"
+            "body{font-family:sans-serif} main{display:flex;flex-wrap:wrap}"
+            "figure{margin:4px;width:256px} img{width:256px;image-rendering:pixelated}"
+            "figcaption{font-size:11px}</style></head>"
+            f"<body><p>{len(store)} maps, page {page}: {nav}</p><main>{cells}</main></body></html>")
+
+
+def make_handler(store, per_page):
+    class Handler(BaseHTTPRequestHandler):
+        def send(self, body, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path.startswith("/map/"):
+                # rendered on request, only the requested map is read from the memmap
+                buffer = io.BytesIO()
+                mat_to_png(store[int(url.path[5:].split(".")[0])], buffer)
+                return self.send(buffer.getvalue(), "image/png")
+            query = parse_qs(url.query)
+            page = int(query.pop("page", ["0"])[0])
+            where = {k: int(v[0]) if v[0].lstrip("-").isdigit() else v[0] for k, v in query.items()}
+            ids = store.select(**where)
+            num_pages = max(1, math.ceil(len(ids) / per_page))
+            extra = "".join(f"&{k}={v}" for k, v in where.items())
+            html = render_page(store, ids[page * per_page:(page + 1) * per_page], page, num_pages,
+                               lambda i: f"/map/{i}.png", lambda p: f"?page={p}{extra}")
+            self.send(html.encode("utf-8"), "text/html; charset=utf-8")
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("path")
+@click.option("--port", type=int, default=8000)
+@click.option("--per-page", type=int, default=100)
+def serve(path, port, per_page):
+    r"""
+    browse the maps, PNGs are rendered when the browser asks for them
+    filter with query parameters, e.g. http://localhost:8000/?layer=3&step=100
+    """
+    store = AttentionStore(path)
+    print(f"{len(store)} maps, http://localhost:{port}/")
+    ThreadingHTTPServer(("", port), make_handler(store, per_page)).serve_forever()
+
+
+def export_pages(store, out_dir, per_page=100, first=0, last=0, workers=None):
+    r"""
+    write page_{first..last}.html with the maps of those pages rendered next to them
+    maps are grouped by stored shape, `render_batch` stacks each group
+    """
+    num_pages = max(1, math.ceil(len(store) / per_page))
+    os.makedirs(out_dir, exist_ok=True)
+    for page in range(first, min(last, num_pages - 1) + 1):
+        ids = list(range(page * per_page, min((page + 1) * per_page, len(store))))
+        groups = {}
+        for i in ids:
+            groups.setdefault(tuple(store.index[i]["stored"]), []).append(i)
+        files = {}
+        for (h, w), group in groups.items():
+            prefix = f"map_{h}x{w}"
+            render_batch(np.stack([store[i] for i in group]), os.path.join(out_dir, f"maps_{page}"),
+                         prefix=prefix, names=("id",), workers=workers)
+            files.update({i: f"maps_{page}/{prefix}_id{j}.png" for j, i in enumerate(group)})
+        html = render_page(store, ids, page, num_pages, files.get, lambda p: f"page_{p}.html")
+        with open(os.path.join(out_dir, f"page_{page}.html"), "w") as f:
+            f.write(html)
+    return out_dir
+
+
+@cli.command()
+@click.argument("path")
+@click.option("--out-dir", type=str, default=None, help="default: PATH/html")
+@click.option("--per-page", type=int, default=100)
+@click.option("--pages", type=str, default="0", help="pages to export, e.g. 0-4")
+@click.option("--workers", type=int, default=None)
+def export(path, out_dir, per_page, pages, workers):
+    r"""
+    static HTML pages, only the maps on the exported pages are rendered
+    """
+    store = AttentionStore(path)
+    first, _, last = pages.partition("-")
+    out_dir = export_pages(store, out_dir or os.path.join(path, "html"), per_page,
+                           int(first), int(last or first), workers)
+    print(f"exported to {out_dir}")
+
+
+@cli.command()
+@click.argument("path")
+@click.option("--num-maps", type=int, default=1000)
+@click.option("--n", type=int, default=1024)
+def demo(path, num_maps, n):
+    r"""
+    fill a store with random softmax maps
+    """
+    rng = np.random.default_rng(0)
+    # mixed sequence lengths (and a rectangular, cross attention like map)
+    shapes = [(n, n), (n // 3, n // 3), (n // 5, n // 2), (n // 10, n // 10)]
+    with AttentionStore(path, size=128) as store:
+        for i in range(num_maps):
+            h, w = shapes[i % len(shapes)]
+            logits = rng.standard_normal((h, w), dtype=np.float32)
+            logits += np.triu(np.full((h, w), -np.inf, dtype=np.float32), 1)
+            attn = np.exp(logits - logits.max(axis=-1, keepdims=True))
+            store.add(attn / attn.sum(axis=-1, keepdims=True), layer=i % 12, head=i // 12 % 16, step=i // 192)
+    print(f"{len(store)} maps in {path}")
+
+    stored = {tuple(entry["stored"]) for entry in store.index[:100]}
+    out_dir = export_pages(store, os.path.join(path, "html"))
+    assert len(stored) > 1 and len(os.listdir(os.path.join(out_dir, "maps_0"))) == min(100, len(store))
+    print(f"exported page 0 ({len(stored)} stored shapes) to {out_dir}")
+
+
+if __name__ == '__main__':
+    r"""
+    Command:
+        python viz/attn_store.py demo attn_dump
+        python viz/attn_store.py serve attn_dump --port 8000
+        python viz/attn_store.py export attn_dump --pages 0-2
+    """
+    cli()
@@ -1,29 +1,350 @@
+r"""
+Compose a grid of images (contact sheet) into one big picture.
+
+Tiles are decoded and resized by a thread pool. The output is written one
+row of tiles at a time, so memory stays bounded no matter how many tiles
+there are:
+- .png: streamed, every strip is deflated into its own IDAT chunk
+- .tif/.tiff: tiled TIFF (pip install tifffile), resolution must be a multiple of 16
+- --pyramid dzi/xyz: a deep zoom tile pyramid for image browsers (OpenSeadragon,
+  Leaflet), each level is downsampled from the rows of the level below, so
+  the full resolution mosaic is never held in memory
+
+pip install click numpy opencv-python
+"""
+
+import glob
+import math
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import click
 import numpy as np
 import cv2
 
-import glob
 
+def load_tile(path, resolution, fit="stretch"):
+    r"""
+    read `path` as a `resolution x resolution` BGR tile, black if unreadable
+    fit:
+        stretch: resize to the square, ignoring the aspect ratio
+        pad:     keep the aspect ratio, center on a black square
+    """
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    tile = np.zeros((resolution, resolution, 3), dtype=np.uint8)
+    if img is None:
+        print(f"could not read {path}, left blank")
+        return tile
+    h, w = img.shape[:2]
+    if (h, w) == (resolution, resolution):
+        return img
+    if fit == "stretch":
+        th, tw = resolution, resolution
+    else:
+        scale = resolution / max(h, w)
+        th, tw = max(1, round(h * scale)), max(1, round(w * scale))
+    # INTER_AREA is the right filter for shrinking, it is slow for enlarging
+    interpolation = cv2.INTER_AREA if th * tw < h * w else cv2.INTER_LINEAR
+    img = cv2.resize(img, (tw, th), interpolation=interpolation)
+    y, x = (resolution - th) // 2, (resolution - tw) // 2
+    tile[y:y + th, x:x + tw] = img
+    return tile
+
+
+def take(it, n):
+    r"""
+    the next (at most) `n` items of the iterator `it`
+    """
+    return [item for _, item in zip(range(n), it)]
+
+
+def iter_strips(files, rows, cols, resolution, fit="stretch", workers=16, prefetch=2):
+    r"""
+    yield the grid one strip (a row of tiles, `resolution x cols*resolution`) at a time
+    at most `prefetch` strips of tiles are decoded ahead of the one being written
+    """
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        it = iter(files)
+
+        def submit_strip():
+            futures = [pool.submit(load_tile, path, resolution, fit) for path in take(it, cols)]
+            pending.append(futures)
+
+        for _ in range(min(prefetch + 1, rows)):
+            submit_strip()
+        for r in range(rows):
+            futures = pending.popleft()
+            if r + prefetch + 1 < rows:
+                submit_strip()
+            strip = np.zeros((resolution, cols * resolution, 3), dtype=np.uint8)
+            for c, future in enumerate(futures):
+                strip[:, c * resolution:(c + 1) * resolution] = future.result()
+            yield strip
+
+
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+class PNGStreamWriter:
+    r"""
+    write an 8-bit RGB PNG strip by strip, only one strip is in memory
+    """
+    def __init__(self, path, width, height, level=6):
+        self.f = open(path, "wb")
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(level)
+        self.f.write(b"\x89PNG\r\n\x1a\n")
+        self.f.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+
+    def write(self, strip):
+        r"""
+        strip: (h, width, 3) BGR uint8
+        """
+        h = strip.shape[0]
+        assert strip.shape[1] == self.width and self.rows_written + h <= self.height
+        # each scanline starts with its filter type (0: none)
+        raw = np.zeros((h, 1 + self.width * 3), dtype=np.uint8)
+        raw[:, 1:] = strip[..., ::-1].reshape(h, -1)
+        data = self.compressor.compress(raw.tobytes())
+        if data:
+            self.f.write(png_chunk(b"IDAT", data))
+        self.rows_written += h
+
+    def close(self):
+        assert self.rows_written == self.height, f"wrote {self.rows_written} of {self.height} rows"
+        self.f.write(png_chunk(b"IDAT", self.compressor.flush()))
+        self.f.write(png_chunk(b"IEND", b""))
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.f.close()
+
+
+def write_png(target_path, strips, width, height, level=6):
+    with PNGStreamWriter(target_path, width, height, level=level) as writer:
+        for strip in strips:
+            writer.write(strip)
+
+
+def write_tiff(target_path, strips, width, height, resolution, compression=None):
+    import tifffile
+
+    if resolution % 16 != 0:
+        raise click.ClickException("tiled TIFF needs a resolution that is a multiple of 16")
+
+    def tiles():
+        for strip in strips:
+            for c in range(width // resolution):
+                yield np.ascontiguousarray(strip[:, c * resolution:(c + 1) * resolution, ::-1])
+
+    tifffile.imwrite(target_path, tiles(), shape=(height, width, 3), dtype=np.uint8,
+                     tile=(resolution, resolution), photometric="rgb", compression=compression,
+                     bigtiff=width * height * 3 > 2 ** 32 - 2 ** 25)
+
+
+def downsample_rows(rows):
+    r"""
+    2x2 box filter, `rows` has an even number of rows, an odd last column is repeated
+    """
+    h, w = rows.shape[:2]
+    if w % 2:
+        rows = np.concatenate([rows, rows[:, -1:]], axis=1)
+        w += 1
+    blocks = rows.reshape(h // 2, 2, w // 2, 2, -1).astype(np.uint16)
+    return ((blocks.sum(axis=(1, 3)) + 2) // 4).astype(np.uint8)
+
+
+class PyramidLevel:
+    r"""
+    one level of the tile pyramid, fed top to bottom with full-width rows
+    keeps less than `tile_size` rows (plus one row to pair for downsampling),
+    cuts them into tiles and passes the 2x downsampled rows to the next (coarser) level
+    """
+    def __init__(self, level, width, height, tile_size, save_tile, next_level=None):
+        self.level = level
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.save_tile = save_tile
+        self.next_level = next_level
+        self.buffer = np.zeros((0, width, 3), dtype=np.uint8)
+        self.carry = None
+        self.tile_row = 0
+
+    def push(self, rows):
+        self.buffer = np.concatenate([self.buffer, rows])
+        while len(self.buffer) >= self.tile_size:
+            self.emit(self.buffer[:self.tile_size])
+            self.buffer = self.buffer[self.tile_size:]
+
+        if self.next_level is not None:
+            if self.carry is not None:
+                rows = np.concatenate([self.carry, rows])
+                self.carry = None
+            if len(rows) % 2:
+                self.carry, rows = rows[-1:], rows[:-1]
+            if len(rows):
+                self.next_level.push(downsample_rows(rows))
+
+    def emit(self, rows):
+        for col, x in enumerate(range(0, self.width, self.tile_size)):
+            self.save_tile(self.level, col, self.tile_row, rows[:, x:x + self.tile_size])
+        self.tile_row += 1
+
+    def finish(self):
+        if len(self.buffer):
+            self.emit(self.buffer)
+            self.buffer = self.buffer[:0]
+        if self.next_level is not None:
+            if self.carry is not None:
+                self.next_level.push(downsample_rows(np.concatenate([self.carry, self.carry])))
+                self.carry = None
+            self.next_level.finish()
+
+
+class TileSaver:
+    r"""
+    encode and write tiles on a thread pool, at most `max_pending` tiles in flight
+    layout:
+        dzi: {name}_files/{level}/{col}_{row}.{fmt}, level 0 is 1x1 pixel
+        xyz: {root}/{z}/{x}/{y}.{fmt}, z 0 is the coarsest level that fits in one tile,
+             edge tiles are padded to full size
+    """
+    def __init__(self, root, layout, tile_size, fmt="png", min_level=0, workers=8, max_pending=64):
+        self.root = root
+        self.layout = layout
+        self.tile_size = tile_size
+        self.fmt = fmt
+        self.min_level = min_level
+        self.pool = ThreadPoolExecutor(workers)
+        self.pending = deque()
+        self.max_pending = max_pending
+        self.made_dirs = set()
+        self.num_tiles = 0
+
+    def path(self, level, col, row):
+        if self.layout == "dzi":
+            return os.path.join(self.root, str(level)), f"{col}_{row}.{self.fmt}"
+        return os.path.join(self.root, str(level - self.min_level), str(col)), f"{row}.{self.fmt}"
+
+    def __call__(self, level, col, row, tile):
+        if self.layout == "xyz" and tile.shape[:2] != (self.tile_size, self.tile_size):
+            padded = np.zeros((self.tile_size, self.tile_size, 3), dtype=np.uint8)
+            padded[:tile.shape[0], :tile.shape[1]] = tile
+            tile = padded
+        else:
+            # contiguous for cv2, and does not keep the whole level buffer alive while queued
+            tile = tile.copy()
+        dir_name, file_name = self.path(level, col, row)
+        if dir_name not in self.made_dirs:
+            os.makedirs(dir_name, exist_ok=True)
+            self.made_dirs.add(dir_name)
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(cv2.imwrite, os.path.join(dir_name, file_name), tile))
+        self.num_tiles += 1
+
+    def close(self):
+        for future in self.pending:
+            future.result()
+        self.pool.shutdown()
+
+
+def write_pyramid(target_path, strips, width, height, layout="dzi", tile_size=256, fmt="png", workers=8):
+    r"""
+    build a deep zoom pyramid from the strips, every level from the one below
+    dzi: target_path is `name.dzi`, tiles go to `name_files/`
+    xyz: target_path is the tile directory
+    """
+    max_level = math.ceil(math.log2(max(width, height))) if max(width, height) > 1 else 0
+    if layout == "dzi":
+        min_level = 0
+        root = os.path.splitext(target_path)[0] + "_files"
+    else:
+        # coarsest level that fits in a single tile
+        min_level = max_level - max(0, math.ceil(math.log2(max(width, height) / tile_size)))
+        root = target_path
+    saver = TileSaver(root, layout, tile_size, fmt=fmt, min_level=min_level, workers=workers)
+
+    levels = None
+    for level in range(min_level, max_level + 1):
+        scale = 2 ** (max_level - level)
+        levels = PyramidLevel(level, math.ceil(width / scale), math.ceil(height / scale),
+                              tile_size, saver, next_level=levels)
+    for strip in strips:
+        levels.push(strip)
+    levels.finish()
+    saver.close()
+
+    if layout == "dzi":
+        with open(target_path, "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{fmt}" '
+                    f'Overlap="0" TileSize="{tile_size}">\n'
+                    f'  <Size Width="{width}" Height="{height}"/>\n'
+                    '</Image>\n')
+    return saver.num_tiles
 
-def main():
-    data_dir = "D:/LOGS/2022-10/val_1w"
-    target_path = "tmp.png"
-    
-    M = 9
-    N = 16
-    resolution = 64
-    suffix = "png"
 
-    total_files = glob.glob(f"{data_dir}/*.{suffix}")
-    total_files = total_files[:(M * N)]
+def list_files(data_dir, suffix, limit=None):
+    total_files = sorted(glob.glob(f"{data_dir}/*.{suffix}"))
+    return total_files[:limit] if limit else total_files
 
-    target_img = np.zeros((M * resolution, N * resolution, 3), dtype=np.uint8)
 
-    for i, _f in enumerate(total_files):
-        img = cv2.imread(_f)
-        target_img[i//N * resolution:(i//N + 1) * resolution, i%N * resolution:(i%N + 1) * resolution] = img
+@click.command()
+@click.option("--data-dir", type=str, default="D:/LOGS/2022-10/val_1w")
+@click.option("--target-path", "-o", type=str, default="tmp.png", help=".png or .tif/.tiff")
+@click.option("--rows", "-M", type=int, default=9, help="0: as many as needed for all files")
+@click.option("--cols", "-N", type=int, default=16)
+@click.option("--resolution", type=int, default=64)
+@click.option("--suffix", type=str, default="png")
+@click.option("--fit", type=click.Choice(["stretch", "pad"]), default="stretch",
+              help="how tiles that are not resolution x resolution are resized")
+@click.option("--workers", type=int, default=16)
+@click.option("--png-level", type=click.IntRange(0, 9), default=6)
+@click.option("--pyramid", type=click.Choice(["none", "dzi", "xyz"]), default="none",
+              help="write a deep zoom tile pyramid instead of a single image")
+@click.option("--tile-size", type=int, default=256)
+@click.option("--tile-format", type=click.Choice(["png", "jpg"]), default="png")
+def main(data_dir, target_path, rows, cols, resolution, suffix, fit, workers, png_level,
+         pyramid, tile_size, tile_format):
+    M, N = rows, cols
+    total_files = list_files(data_dir, suffix, limit=M * N if M else None)
+    if not M:
+        M = max(1, math.ceil(len(total_files) / N))
 
-    cv2.imwrite(filename=target_path, img=target_img)
+    width, height = N * resolution, M * resolution
+    strips = iter_strips(total_files, M, N, resolution, fit=fit, workers=workers)
+    if pyramid != "none":
+        num_tiles = write_pyramid(target_path, strips, width, height, layout=pyramid,
+                                  tile_size=tile_size, fmt=tile_format, workers=workers)
+        print(f"{len(total_files)} images -> {num_tiles} pyramid tiles in {target_path}")
+        return
+    if os.path.splitext(target_path)[1].lower() in (".tif", ".tiff"):
+        write_tiff(target_path, strips, width, height, resolution)
+    else:
+        write_png(target_path, strips, width, height, level=png_level)
+    print(f"{len(total_files)} tiles -> {target_path} ({width}x{height})")
 
 
 if __name__ == '__main__':
+    r"""
+    Command:
+        python viz/make_big_pic.py --data-dir val_1w -M 9 -N 16 --resolution 64 -o tmp.png
+        python viz/make_big_pic.py --data-dir val_1w -M 0 -N 316 --resolution 64 -o sheet.tif
+        python viz/make_big_pic.py --data-dir val_1w -M 0 -N 316 --pyramid dzi -o val_1w.dzi
+    """
     main()
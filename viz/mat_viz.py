@@ -1,22 +1,125 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+
+def to_numpy(mat):
+    if hasattr(mat, "detach"):  # torch.Tensor
+        mat = mat.detach().float().cpu().numpy()
+    return np.asarray(mat, dtype=np.float32)
+
+
+def pool_matrix(mat, max_size=1024, mode="max"):
+    r"""
+    shrink `mat` with k x k max / mean pooling until both sides are <= max_size
+    max pooling keeps sharp attention peaks visible, mean keeps the overall mass
+    """
+    mat = to_numpy(mat)
+    h, w = mat.shape
+    k = math.ceil(max(h, w) / max_size)
+    if k <= 1:
+        return mat
+    ph, pw = math.ceil(h / k) * k, math.ceil(w / k) * k
+    if (ph, pw) != (h, w):
+        mat = np.pad(mat, ((0, ph - h), (0, pw - w)), constant_values=np.nan)
+    blocks = mat.reshape(ph // k, k, pw // k, k)
+    reduce = np.nanmax if mode == "max" else np.nanmean
+    return reduce(blocks, axis=(1, 3))
 
 
-def simple_mat_viz(mat, save_fn="test.png"):
+def simple_mat_viz(mat, save_fn="test.png", grid_threshold=64, max_size=1024, pool="max"):
     r"""
     visualize the matrix
+    grid lines are drawn (as one LineCollection) only up to `grid_threshold` cells per side,
+    matrices larger than `max_size` are pooled first
     """
+    mat = pool_matrix(mat, max_size=max_size, mode=pool)
     plt.matshow(mat)
     h, w = mat.shape
 
-    for ii in range(h): plt.axhline(ii+0.5, color='k', linestyle='-')
-    for ii in range(w): plt.axvline(ii+0.5, color='k', linestyle='-')
+    if max(h, w) <= grid_threshold:
+        lines = [[(-0.5, ii + 0.5), (w - 0.5, ii + 0.5)] for ii in range(h)]
+        lines += [[(ii + 0.5, -0.5), (ii + 0.5, h - 0.5)] for ii in range(w)]
+        plt.gca().add_collection(LineCollection(lines, colors='k', linestyles='-'))
 
     plt.savefig(save_fn)
+    plt.close()
+
+
+def mat_to_png(mat, save_fn="test.png", cmap="viridis", vmin=None, vmax=None, max_size=1024, pool="max",
+               scale=None, grid=True):
+    r"""
+    write the matrix straight to a PNG, one cell -> `scale` x `scale` pixels, no figure
+    scale:  default enlarges small matrices to about 512 pixels
+    grid:   draw black cell borders when a cell is at least 4 pixels wide
+    """
+    mat = pool_matrix(mat, max_size=max_size, mode=pool)
+    vmin = np.nanmin(mat) if vmin is None else vmin
+    vmax = np.nanmax(mat) if vmax is None else vmax
+    norm = (mat - vmin) / (vmax - vmin) if vmax > vmin else np.zeros_like(mat)
+    index = np.clip(np.nan_to_num(norm) * 255 + 0.5, 0, 255).astype(np.uint8)
+    lut = (matplotlib.colormaps[cmap](np.arange(256))[:, :3] * 255).astype(np.uint8)
+    rgb = lut[index]
+
+    if scale is None:
+        scale = max(1, 512 // max(mat.shape))
+    if scale > 1:
+        rgb = rgb.repeat(scale, axis=0).repeat(scale, axis=1)
+        if grid and scale >= 4:
+            rgb[::scale] = 0
+            rgb[:, ::scale] = 0
+    plt.imsave(save_fn, rgb)
+
+
+def _init_worker():
+    # workers only write files, a GUI backend would be slow or fail without a display
+    matplotlib.use("Agg")
+
+
+def _render_one(job):
+    mat, save_fn, fast, kwargs = job
+    if fast:
+        mat_to_png(mat, save_fn, **kwargs)
+    else:
+        simple_mat_viz(mat, save_fn, **kwargs)
+    return save_fn
+
+
+def render_batch(mats, out_dir, prefix="attn", fast=True, workers=None, names=("layer", "head"), **kwargs):
+    r"""
+    render every matrix of `mats` (..., h, w), e.g. (layers, heads, n, n), in parallel
+    each matrix is pooled in the parent first, so only small arrays go to the workers
+    Returns:
+        the file names, {out_dir}/{prefix}_layer{i}_head{j}.png
+    """
+    mats = to_numpy(mats)
+    lead = mats.shape[:-2]
+    names = (tuple(f"dim{i}" for i in range(len(lead))) + tuple(names))[-len(lead):] if lead else ()
+    os.makedirs(out_dir, exist_ok=True)
+    pool_kwargs = {key: kwargs[key] for key in ("max_size", "pool") if key in kwargs}
+
+    jobs = []
+    for index in np.ndindex(*lead):
+        tag = "".join(f"_{name}{i}" for name, i in zip(names, index))
+        jobs.append((pool_matrix(mats[index], **pool_kwargs), os.path.join(out_dir, f"{prefix}{tag}.png"), fast, kwargs))
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        return list(pool.map(_render_one, jobs, chunksize=max(1, len(jobs) // (4 * (workers or os.cpu_count())))))
 
 
 if __name__ == '__main__':
     import torch
+    matplotlib.use("Agg")
     attn_matrix = torch.ones(4, 4)
     attn_matrix = torch.triu(attn_matrix)
 
-    simple_mat_viz(1 - attn_matrix)
\ No newline at end of file
+    simple_mat_viz(1 - attn_matrix)
+
+    # 2 layers x 8 heads of a 4096 x 4096 attention map
+    attn = torch.softmax(torch.randn(2, 8, 4096, 4096), dim=-1)
+    print(render_batch(attn, "attn_viz", max_size=512)[:4])
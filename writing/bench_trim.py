@@ -0,0 +1,53 @@
+"""
+Benchmark the edge detection of trim_figure.py on large synthetic figures.
+
+python bench_trim.py --width 7680 --height 4320
+"""
+
+import time
+
+import click
+import numpy as np
+
+from trim_figure import detect_edges, detect_edges_findnonzero
+
+
+def make_figure(width, height, margin, density, seed=0):
+    """White canvas with a dense block of random content inside a margin"""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    h, w = height - 2 * margin, width - 2 * margin
+    content = rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8)
+    # keep `density` of the pixels dark, the rest white
+    keep = rng.random((h, w)) < density
+    img[margin:margin + h, margin:margin + w][keep] = content[keep] // 2
+    return img
+
+
+def timeit(fn, img, repeat):
+    fn(img)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(img)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2], result
+
+
+@click.command()
+@click.option('--width', type=int, default=7680)
+@click.option('--height', type=int, default=4320)
+@click.option('--repeat', type=int, default=10)
+def main(width, height, repeat):
+    print(f"{'figure':<28}{'findNonZero (ms)':>18}{'projections (ms)':>18}{'speedup':>10}")
+    for margin, density in [(400, 0.9), (400, 0.05), (20, 0.9), (0, 1.0)]:
+        img = make_figure(width, height, margin, density)
+        old, old_bounds = timeit(detect_edges_findnonzero, img, repeat)
+        new, new_bounds = timeit(detect_edges, img, repeat)
+        assert old_bounds == new_bounds, f"bounds differ: {old_bounds} vs {new_bounds}"
+        name = f"margin {margin}, density {density}"
+        print(f"{name:<28}{old * 1000:>18.1f}{new * 1000:>18.1f}{old / new:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
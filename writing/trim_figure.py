@@ -1,19 +1,29 @@
 """
 Trim white space from images (PNG, JPEG) or PDFs.
 
-pip install click Pillow opencv-python PyMuPDF numpy
+pip install click opencv-python PyMuPDF numpy
 """
 
 import click
 import fitz  # PyMuPDF
 import numpy as np
-from PIL import Image
 import os
 from pathlib import Path
 import cv2
+import glob
+import hashlib
+import json
+import re
+import shutil
+import sqlite3
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def detect_edges(img_array):
-    """Detect edges of content in image by finding non-white pixels"""
+SUPPORTED_EXTS = ['.pdf', '.png', '.jpg', '.jpeg']
+
+def detect_edges_findnonzero(img_array):
+    """Previous implementation (threshold + cv2.findNonZero), kept for benchmarks"""
     # Convert to grayscale if it's a color image
     if len(img_array.shape) == 3:
         gray = cv2.cvtColor(img_array, cv2.COLOR_BGR2GRAY)
@@ -32,54 +42,424 @@ def detect_edges(img_array):
     x, y, w, h = cv2.boundingRect(coords)
     return (x, y, w, h)
 
-def trim_image(input_path, output_path):
+def content_mask(block, background=None, tolerance=5, alpha_threshold=0):
+    """
+    Boolean mask of the content pixels of an (h, w[, c]) uint8 block.
+    background=None: darker than white by more than `tolerance` in grayscale
+    (the default matches the old threshold of 250); otherwise a BGR tuple or a
+    gray value, any channel off by more than `tolerance` is content.
+    With an alpha channel, pixels with alpha <= `alpha_threshold` are background.
+    """
+    alpha = None
+    if block.ndim == 3 and block.shape[2] == 4:
+        alpha = block[..., 3]
+        block = block[..., :3]
+    if background is None:
+        if block.ndim == 3:
+            block = cv2.cvtColor(np.ascontiguousarray(block), cv2.COLOR_BGR2GRAY)
+        mask = block < 256 - tolerance
+    else:
+        background = np.asarray(background, dtype=np.float64)
+        if block.ndim == 2 and background.ndim == 1:
+            # grayscale image (IMREAD_UNCHANGED keeps it 2-D), BGR background -> gray as cv2 does
+            background = background[:3] @ np.array([0.114, 0.587, 0.299])
+        diff = np.abs(block.astype(np.int16) - np.rint(background).astype(np.int16))
+        mask = (diff.max(axis=-1) if diff.ndim == 3 else diff) > tolerance
+    if alpha is not None:
+        mask &= alpha > alpha_threshold
+    return mask
+
+def detect_edges(img_array, background=None, tolerance=5, alpha_threshold=0, padding=0, step=64):
+    """
+    Detect edges of content in image by finding non-background pixels.
+
+    Scans blocks of `step` rows from the top and bottom border and stops at
+    the first one with content, then does the same for columns within the
+    content rows. Only the margins (plus one block per side) are examined and
+    no coordinate array is allocated. Returns (x, y, w, h) or None.
+    """
+    h, w = img_array.shape[:2]
+
+    def mask(rows, cols):
+        return content_mask(img_array[rows, cols], background, tolerance, alpha_threshold)
+
+    def first(length, project, reverse=False):
+        starts = range(0, length, step)
+        for start in (reversed(starts) if reverse else starts):
+            hits = project(slice(start, min(start + step, length)))
+            if hits.any():
+                idx = np.flatnonzero(hits)
+                return start + int(idx[-1] if reverse else idx[0])
+        return None
+
+    top = first(h, lambda rows: mask(rows, slice(None)).any(axis=1))
+    if top is None:
+        return None
+    bottom = first(h, lambda rows: mask(rows, slice(None)).any(axis=1), reverse=True)
+    band = slice(top, bottom + 1)
+    left = first(w, lambda cols: mask(band, cols).any(axis=0))
+    right = first(w, lambda cols: mask(band, cols).any(axis=0), reverse=True)
+
+    x0, y0 = max(left - padding, 0), max(top - padding, 0)
+    x1, y1 = min(right + 1 + padding, w), min(bottom + 1 + padding, h)
+    return (x0, y0, x1 - x0, y1 - y0)
+
+PNG_STRATEGIES = {
+    'default': cv2.IMWRITE_PNG_STRATEGY_DEFAULT,
+    'filtered': cv2.IMWRITE_PNG_STRATEGY_FILTERED,
+    'huffman': cv2.IMWRITE_PNG_STRATEGY_HUFFMAN_ONLY,
+    'rle': cv2.IMWRITE_PNG_STRATEGY_RLE,
+    'fixed': cv2.IMWRITE_PNG_STRATEGY_FIXED,
+}
+
+# ancillary chunks describing color and resolution, plus text
+PNG_META_CHUNKS = {b'iCCP', b'sRGB', b'gAMA', b'cHRM', b'pHYs', b'tEXt', b'iTXt', b'zTXt'}
+
+def png_chunks(data):
+    """Split a PNG into (type, raw chunk bytes) pairs"""
+    pos, chunks = 8, []
+    while pos < len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        chunks.append((data[pos + 4:pos + 8], data[pos:pos + 12 + length]))
+        pos += 12 + length
+    return chunks
+
+def copy_png_metadata(src, dst):
+    """Copy ICC profile, gamma, DPI and text chunks of `src` into the encoded `dst` (no re-encoding)"""
+    meta = [raw for kind, raw in png_chunks(src) if kind in PNG_META_CHUNKS]
+    out = [dst[:8]]
+    for kind, raw in png_chunks(dst):
+        if kind in PNG_META_CHUNKS:
+            continue
+        out.append(raw)
+        # they must come before PLTE / IDAT, right after IHDR is always valid
+        if kind == b'IHDR':
+            out.extend(meta)
+    return b''.join(out)
+
+def jpeg_segments(data):
+    """Header segments (marker, raw bytes) of a JPEG up to the start of scan"""
+    pos, segments = 2, []
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker == 0xDA:  # SOS, entropy coded data follows
+            break
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        segments.append((marker, data[pos:pos + 2 + length]))
+        pos += 2 + length
+    return segments, pos
+
+def copy_jpeg_metadata(src, dst):
+    """Replace the APPn/COM segments (JFIF density, EXIF, ICC profile, ...) of `dst` with those of `src`"""
+    meta = [raw for marker, raw in jpeg_segments(src)[0] if 0xE0 <= marker <= 0xEF or marker == 0xFE]
+    segments, pos = jpeg_segments(dst)
+    rest = [raw for marker, raw in segments if not (0xE0 <= marker <= 0xEF or marker == 0xFE)]
+    return dst[:2] + b''.join(meta) + b''.join(rest) + dst[pos:]
+
+def lossless_jpeg_crop(input_path, output_path, bounds):
+    """
+    Crop a JPEG without decoding it (jpegtran from libjpeg-turbo). The upper
+    left corner moves up/left to the nearest MCU boundary, so a few extra
+    pixels may be kept. Returns False if jpegtran is not installed.
+    """
+    jpegtran = shutil.which('jpegtran')
+    if jpegtran is None:
+        return False
+    x, y, w, h = bounds
+    subprocess.run([jpegtran, '-copy', 'all', '-optimize', '-crop', f'{w}x{h}+{x}+{y}',
+                    '-outfile', str(output_path), str(input_path)], check=True)
+    return True
+
+def trim_image(input_path, output_path, png_level=1, png_strategy='default', jpeg_quality=95,
+               lossless_jpeg=True, **image_options):
     """Trim white space from image formats (PNG, JPEG)"""
-    # Read image
-    img = cv2.imread(str(input_path))
+    # Read image, keep alpha (and 16-bit depth) if present
+    with open(input_path, 'rb') as f:
+        data = f.read()
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
     if img is None:
         raise ValueError(f"Could not read image: {input_path}")
     
     # Detect edges
-    bounds = detect_edges(img)
+    detect_img = img if img.dtype == np.uint8 else (img >> 8).astype(np.uint8)
+    bounds = detect_edges(detect_img, **image_options)
     if bounds is None:
         print(f"No content found in {input_path}")
         return
     
+    src_ext = Path(input_path).suffix.lower()
+    ext = Path(output_path).suffix.lower()
+    jpeg_exts = ['.jpg', '.jpeg']
+    if lossless_jpeg and src_ext in jpeg_exts and ext in jpeg_exts:
+        if lossless_jpeg_crop(input_path, output_path, bounds):
+            return
+    
     x, y, w, h = bounds
     
     # Crop image
     cropped = img[y:y+h, x:x+w]
     
     # Save cropped image
-    cv2.imwrite(str(output_path), cropped)
+    if ext == '.png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_level, cv2.IMWRITE_PNG_STRATEGY, PNG_STRATEGIES[png_strategy]]
+    else:
+        params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+    ok, encoded = cv2.imencode(ext, cropped, params)
+    if not ok:
+        raise ValueError(f"Could not encode image: {output_path}")
+    encoded = encoded.tobytes()
+    # keep ICC profile, DPI and other metadata when the format is unchanged
+    if src_ext == ext == '.png':
+        encoded = copy_png_metadata(data, encoded)
+    elif src_ext in jpeg_exts and ext in jpeg_exts:
+        encoded = copy_jpeg_metadata(data, encoded)
+    with open(output_path, 'wb') as f:
+        f.write(encoded)
+
+def pixmap_to_array(pix):
+    """Wrap the samples of a pixmap as a numpy array without copying"""
+    buffer = pix.samples_mv if hasattr(pix, "samples_mv") else pix.samples
+    arr = np.frombuffer(buffer, dtype=np.uint8).reshape(pix.height, pix.stride)
+    arr = arr[:, :pix.width * pix.n]
+    if pix.n == 1:
+        return arr
+    return arr.reshape(pix.height, pix.width, pix.n)
+
+def _is_background(drawing):
+    """White, unstroked fills (e.g. the figure patch of matplotlib) are not content"""
+    fill = drawing.get("fill")
+    return (drawing.get("color") is None and fill is not None
+            and all(c >= 0.98 for c in fill))
+
+def vector_bounds(page):
+    """
+    Content bounds from the PDF objects (drawings, text and image bboxes)
+    without rasterizing. Returns (rect or None, has_images)
+    """
+    rects = []
+    # active clip paths as (level, scissor): a clip applies to the items nested below it
+    clips = []
+    for drawing in page.get_drawings(extended=True):
+        level = drawing.get("level", 0)
+        while clips and clips[-1][0] >= level:
+            clips.pop()
+        if drawing["type"] == "clip":
+            scissor = fitz.Rect(drawing["scissor"])
+            clips.append((level, scissor & clips[-1][1] if clips else scissor))
+            continue
+        if drawing["type"] == "group" or _is_background(drawing):
+            continue
+        # strokes extend half the line width beyond the path
+        r = fitz.Rect(drawing["rect"])
+        pad = (drawing.get("width") or 0) / 2
+        r = r + (-pad, -pad, pad, pad)
+        # e.g. a matplotlib line clipped by set_xlim / set_ylim
+        if clips:
+            r &= clips[-1][1]
+        rects.append(r)
+    for block in page.get_text("blocks"):
+        rects.append(fitz.Rect(block[:4]))
+    images = page.get_image_info()
+    for image in images:
+        rects.append(fitz.Rect(image["bbox"]))
+
+    bounds = None
+    for r in rects:
+        if not r.is_empty:
+            bounds = fitz.Rect(r) if bounds is None else bounds | r
+    if bounds is not None:
+        bounds &= page.rect
+        if bounds.is_empty:
+            bounds = None
+    return bounds, len(images) > 0
+
+def render_bounds(page, clip=None, zoom=1.0, threshold=251):
+    """
+    Render (part of) a page in grayscale and return the rect of the pixels
+    darker than `threshold` in page coordinates (251: same as detect_edges)
+    """
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, colorspace=fitz.csGRAY, alpha=False)
+    gray = pixmap_to_array(pix)
+    rows = np.flatnonzero((gray < threshold).any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero((gray[rows[0]:rows[-1] + 1] < threshold).any(axis=0))
+    x0, y0 = pix.x / zoom, pix.y / zoom
+    return fitz.Rect(x0 + cols[0] / zoom, y0 + rows[0] / zoom,
+                     x0 + (cols[-1] + 1) / zoom, y0 + (rows[-1] + 1) / zoom)
+
+def raster_bounds(page, low_zoom=0.25):
+    """
+    Coarse bounds from a low-DPI render, then refine each edge by rendering
+    only a thin strip around it at full resolution (72 dpi, as before)
+    """
+    # anything that is not pure white counts at low resolution, anti-aliasing
+    # turns thin dark lines into light gray pixels
+    coarse = render_bounds(page, zoom=low_zoom, threshold=255)
+    if coarse is None:
+        return None
+    m = 2 / low_zoom
+    return refine_bounds(page, coarse, outer=m, inner=m)
+
+def refine_bounds(page, coarse, outer, inner):
+    """
+    Exact (72 dpi render) bounds near an estimate: each edge is searched in a
+    strip from `outer` outside to `inner` inside the coarse edge
+    """
+    area = (coarse + (-outer, -outer, outer, outer)) & page.rect
+    strips = [
+        fitz.Rect(area.x0, area.y0, min(coarse.x0 + inner, area.x1), area.y1),  # left
+        fitz.Rect(max(coarse.x1 - inner, area.x0), area.y0, area.x1, area.y1),  # right
+        fitz.Rect(area.x0, area.y0, area.x1, min(coarse.y0 + inner, area.y1)),  # top
+        fitz.Rect(area.x0, max(coarse.y1 - inner, area.y0), area.x1, area.y1),  # bottom
+    ]
+    left, right, top, bottom = [render_bounds(page, clip=strip) for strip in strips]
+    if None in (left, right, top, bottom):
+        # an edge is further inside than the strips reach, render the whole area
+        return render_bounds(page, clip=area)
+    return fitz.Rect(left.x0, top.y0, right.x1, bottom.y1)
+
+def page_bounds(page, engine="auto"):
+    """
+    Content bounds of a page in PDF coordinates.
+    engine: vector (PDF objects only), raster (low-DPI render + refinement),
+    auto (vector bounds refined to the rendered ink by thin strips, the same
+    result as raster; raster if the page has images or no vector content)
+    """
+    if engine in ("auto", "vector"):
+        bounds, has_images = vector_bounds(page)
+        if engine == "vector":
+            return bounds
+        if bounds is not None and not has_images:
+            # object bboxes overshoot the ink (font ascent / descent, joins),
+            # the strips reach 16pt inside and 2pt outside of them
+            return refine_bounds(page, bounds, outer=2, inner=16)
+    return raster_bounds(page)
+
+class BoundsCache:
+    """
+    Page bounds keyed by a hash of the page content, shared by all runs
+    (sqlite, so parallel batch workers can use it at the same time)
+    """
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS bounds (key TEXT PRIMARY KEY, rect TEXT)")
+
+    def get(self, key):
+        """Returns (found, rect or None)"""
+        row = self.conn.execute("SELECT rect FROM bounds WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        rect = json.loads(row[0])
+        return True, (None if rect is None else fitz.Rect(rect))
 
-def trim_pdf(input_path, output_path):
+    def put(self, key, rect):
+        value = json.dumps(None if rect is None else list(rect))
+        self.conn.execute("INSERT OR REPLACE INTO bounds (key, rect) VALUES (?, ?)", (key, value))
+
+    def close(self):
+        self.conn.close()
+
+DEFAULT_BOUNDS_CACHE = Path.home() / ".cache" / "trim_figure" / "bounds.sqlite"
+
+XOBJECT_REF = re.compile(r"/[^\s/<>\[\]()]+\s+(\d+)\s+0\s+R")
+
+def xobject_xrefs(doc, page):
+    """Xrefs of every image and Form XObject the page draws, including the ones nested in forms"""
+    todo = [item[0] for item in page.get_xobjects()] + [item[0] for item in page.get_images(full=True)]
+    seen = set()
+    while todo:
+        xref = todo.pop()
+        if xref <= 0 or xref in seen:
+            continue
+        seen.add(xref)
+        kind, value = doc.xref_get_key(xref, "Resources/XObject")
+        if kind == "xref":  # indirect resource dictionary
+            value = doc.xref_object(int(value.split()[0]))
+        if kind in ("dict", "xref"):
+            todo.extend(int(ref) for ref in XOBJECT_REF.findall(value))
+        # soft masks are drawn too
+        kind, value = doc.xref_get_key(xref, "SMask")
+        if kind == "xref":
+            todo.append(int(value.split()[0]))
+    return sorted(seen)
+
+def page_key(page, engine):
+    """Hash of the content stream(s) of a page, every XObject it draws (recursively) and what else changes its bounds"""
+    doc = page.parent
+    h = hashlib.sha256(page.read_contents())
+    h.update(repr((tuple(page.rect), page.rotation, engine)).encode())
+    # matplotlib / inkscape figures keep their drawing in Form XObjects, images keep their pixels in theirs
+    for xref in xobject_xrefs(doc, page):
+        h.update(doc.xref_object(xref, compressed=True).encode())
+        h.update(doc.xref_stream_raw(xref) or b"")
+    return h.hexdigest()
+
+def _bounds_job(input_path, page_nums, engine):
+    """Worker: open the document itself and compute bounds of some pages"""
+    with fitz.open(input_path) as doc:
+        results = []
+        for page_num in page_nums:
+            rect = page_bounds(doc[page_num], engine)
+            results.append((page_num, None if rect is None else tuple(rect)))
+    return results
+
+def pdf_bounds(input_path, doc, engine="auto", jobs=None, cache=None):
+    """
+    Bounds of every page, cached pages are looked up by content hash and the
+    rest are computed across a process pool (inline for a few pages)
+    """
+    keys = [page_key(doc[n], engine) for n in range(len(doc))] if cache is not None else None
+    bounds = {}
+    missing = []
+    for page_num in range(len(doc)):
+        found, rect = cache.get(keys[page_num]) if cache is not None else (False, None)
+        if found:
+            bounds[page_num] = rect
+        else:
+            missing.append(page_num)
+
+    if jobs == 1 or len(missing) < 8:
+        for page_num in missing:
+            bounds[page_num] = page_bounds(doc[page_num], engine)
+    else:
+        jobs = jobs or os.cpu_count()
+        chunks = [missing[i::jobs * 4] for i in range(min(jobs * 4, len(missing)))]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(_bounds_job, str(input_path), chunk, engine) for chunk in chunks]
+            for future in as_completed(futures):
+                for page_num, rect in future.result():
+                    bounds[page_num] = None if rect is None else fitz.Rect(rect)
+
+    if cache is not None:
+        for page_num in missing:
+            cache.put(keys[page_num], bounds[page_num])
+    if len(doc) > 1:
+        print(f"{input_path}: {len(doc) - len(missing)}/{len(doc)} page bounds cached")
+    return bounds
+
+def trim_pdf(input_path, output_path, engine="auto", jobs=None, cache_path=DEFAULT_BOUNDS_CACHE, padding=0):
     """Trim white space from PDF while maintaining PDF format"""
     # Open PDF
     doc = fitz.open(input_path)
     new_doc = fitz.open()
+    cache = BoundsCache(cache_path) if cache_path is not None else None
+    bounds = pdf_bounds(input_path, doc, engine=engine, jobs=jobs, cache=cache)
+    if cache is not None:
+        cache.close()
     
     for page_num in range(len(doc)):
-        page = doc[page_num]
-        
-        # Convert page to image for edge detection
-        pix = page.get_pixmap()
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        img_array = np.array(img)
-        
         # Detect edges
-        bounds = detect_edges(img_array)
-        if bounds is None:
+        rect = bounds[page_num]
+        if rect is None:
             print(f"No content found in page {page_num+1}")
             continue
-            
-        x, y, w, h = bounds
-        
-        # Convert pixel coordinates to PDF coordinates
-        rect = fitz.Rect(x, y, x+w, y+h)
+        if padding:
+            rect = (rect + (-padding, -padding, padding, padding)) & doc[page_num].rect
         
         # Create new page with detected size
-        new_page = new_doc.new_page(width=w, height=h)
+        new_page = new_doc.new_page(width=rect.width, height=rect.height)
         
         # Copy content from original page to new page
         new_page.show_pdf_page(
@@ -94,31 +474,132 @@ def trim_pdf(input_path, output_path):
     new_doc.close()
     doc.close()
 
-@click.command()
-@click.argument('input_path', type=click.Path(exists=True))
-@click.argument('output_path', type=click.Path())
-def main(input_path, output_path):
-    """
-    Trim white space from images and PDFs.
-    Supports PDF, PNG, and JPEG formats.
-    """
+def trim_file(input_path, output_path, engine="auto", jobs=None, cache_path=DEFAULT_BOUNDS_CACHE, image_options=None):
+    """Trim a single file based on its extension"""
     input_path = Path(input_path)
     output_path = Path(output_path)
-    
+
     # Check if output directory exists, if not create it
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    
+
     # Process based on file extension
     ext = input_path.suffix.lower()
-    
+    image_options = image_options or {}
+    if ext == '.pdf':
+        trim_pdf(input_path, output_path, engine=engine, jobs=jobs, cache_path=cache_path,
+                 padding=image_options.get('padding', 0))
+    elif ext in ['.png', '.jpg', '.jpeg']:
+        trim_image(input_path, output_path, **image_options)
+    else:
+        raise ValueError(f"Unsupported file format: {ext}")
+
+def _trim_job(input_path, output_path, engine="auto", cache_path=DEFAULT_BOUNDS_CACHE, image_options=None):
+    """Worker entry for batch mode, returns (input, output, seconds, error)"""
+    start = time.perf_counter()
     try:
-        if ext == '.pdf':
-            trim_pdf(input_path, output_path)
-        elif ext in ['.png', '.jpg', '.jpeg']:
-            trim_image(input_path, output_path)
-        else:
-            raise ValueError(f"Unsupported file format: {ext}")
-            
+        # files are already spread over the pool, pages stay in this process
+        trim_file(input_path, output_path, engine=engine, jobs=1, cache_path=cache_path,
+                  image_options=image_options)
+        error = None
+    except Exception as e:
+        error = str(e)
+    return input_path, output_path, time.perf_counter() - start, error
+
+def collect_jobs(input_path, output_dir):
+    """
+    Expand a directory or glob into (input, output) pairs, mirroring the
+    directory layout below the input root into `output_dir`
+    """
+    if glob.has_magic(input_path):
+        files = glob.glob(input_path, recursive=True)
+        # root = the part of the pattern before the first wildcard
+        parts = Path(input_path).parts
+        root = Path(*parts[:next(i for i, p in enumerate(parts) if glob.has_magic(p))] or ['.'])
+    else:
+        root = Path(input_path)
+        files = [str(p) for p in root.rglob('*')]
+    files = sorted(f for f in files if Path(f).suffix.lower() in SUPPORTED_EXTS and os.path.isfile(f))
+    return [(f, Path(output_dir) / Path(f).relative_to(root)) for f in files]
+
+def is_up_to_date(input_path, output_path):
+    """make-style check: output exists and is newer than the input"""
+    return output_path.exists() and output_path.stat().st_mtime >= Path(input_path).stat().st_mtime
+
+def trim_batch(input_path, output_dir, jobs=None, force=False, engine="auto", cache_path=DEFAULT_BOUNDS_CACHE,
+               image_options=None):
+    """Trim every supported file below a directory / matching a glob in a process pool"""
+    pairs = collect_jobs(input_path, output_dir)
+    todo = [(i, o) for i, o in pairs if force or not is_up_to_date(i, o)]
+    print(f"{len(pairs)} files, {len(pairs) - len(todo)} up to date, {len(todo)} to trim")
+    if not todo:
+        return
+
+    start = time.perf_counter()
+    num_bytes = 0
+    failed = 0
+    # each worker imports cv2 / fitz once and trims many files
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_trim_job, i, o, engine, cache_path, image_options) for i, o in todo]
+        for future in as_completed(futures):
+            input_file, output_file, seconds, error = future.result()
+            num_bytes += os.path.getsize(input_file)
+            if error is None:
+                print(f"{seconds * 1000:8.1f} ms  {input_file} -> {output_file}")
+            else:
+                failed += 1
+                print(f"{seconds * 1000:8.1f} ms  Error processing {input_file}: {error}")
+    elapsed = time.perf_counter() - start
+    print(f"Trimmed {len(todo) - failed}/{len(todo)} files in {elapsed:.2f}s "
+          f"({len(todo) / elapsed:.1f} files/s, {num_bytes / elapsed / 1e6:.1f} MB/s)")
+
+@click.command()
+@click.argument('input_path', type=str)
+@click.argument('output_path', type=click.Path())
+@click.option('--jobs', '-j', type=int, default=None, help='Worker processes for files (batch) or pages (default: all cores)')
+@click.option('--force', is_flag=True, help='Trim even if the output is newer than the input')
+@click.option('--engine', type=click.Choice(['auto', 'vector', 'raster']), default='auto',
+              help='PDF bounds: PDF objects, low-DPI render + refinement, or vector with raster fallback')
+@click.option('--no-cache', is_flag=True, help=f'Do not use the page bounds cache ({DEFAULT_BOUNDS_CACHE})')
+@click.option('--background', type=str, default=None,
+              help='Background color as B,G,R or a gray value (default: near-white)')
+@click.option('--tolerance', type=int, default=5, help='Max difference from the background that still counts as background')
+@click.option('--alpha-threshold', type=int, default=0, help='Pixels with alpha <= this are background')
+@click.option('--padding', type=int, default=0, help='Margin kept around the content (pixels, points for PDF)')
+@click.option('--png-level', type=click.IntRange(0, 9), default=1, help='PNG compression: 0-1 fast, 9 smallest')
+@click.option('--png-strategy', type=click.Choice(list(PNG_STRATEGIES)), default='default',
+              help='zlib strategy for PNG (rle/huffman are fast, default/filtered small)')
+@click.option('--jpeg-quality', type=int, default=95, help='Quality when a JPEG has to be re-encoded')
+@click.option('--no-lossless-jpeg', is_flag=True, help='Re-encode JPEGs instead of cropping them with jpegtran')
+def main(input_path, output_path, jobs, force, engine, no_cache, background, tolerance, alpha_threshold, padding,
+         png_level, png_strategy, jpeg_quality, no_lossless_jpeg):
+    """
+    Trim white space from images and PDFs.
+    Supports PDF, PNG, and JPEG formats.
+
+    INPUT_PATH can also be a directory or a glob (quote it), in which case
+    OUTPUT_PATH is a directory that mirrors the input tree:
+
+        python trim_figure.py figures/ trimmed/ -j 8
+        python trim_figure.py "figures/**/*.pdf" trimmed/
+    """
+    cache_path = None if no_cache else DEFAULT_BOUNDS_CACHE
+    if background is not None:
+        background = tuple(int(c) for c in background.split(','))
+        background = background[0] if len(background) == 1 else background
+    image_options = dict(background=background, tolerance=tolerance,
+                         alpha_threshold=alpha_threshold, padding=padding,
+                         png_level=png_level, png_strategy=png_strategy,
+                         jpeg_quality=jpeg_quality, lossless_jpeg=not no_lossless_jpeg)
+    if os.path.isdir(input_path) or glob.has_magic(input_path):
+        trim_batch(input_path, output_path, jobs=jobs, force=force, engine=engine, cache_path=cache_path,
+                   image_options=image_options)
+        return
+    if not os.path.exists(input_path):
+        raise click.BadParameter(f"Path '{input_path}' does not exist.", param_hint="INPUT_PATH")
+
+    try:
+        trim_file(input_path, output_path, engine=engine, jobs=jobs, cache_path=cache_path,
+                  image_options=image_options)
         print(f"Successfully trimmed {input_path} to {output_path}")
         
     except Exception as e: